@@ -6,12 +6,12 @@ import argparse
 import logging
 import os
 import re
-import shutil
 import subprocess
 import sys
+import time
+import traceback
+from contextlib import contextmanager
 from functools import partial
-from StringIO import StringIO
-from zipfile import ZipFile
 from buildtools.localeTools import read_locale_config
 from buildtools.ci import lint_gitlab_config, upload_to_stores
 
@@ -126,8 +126,37 @@ def build_available_subcommands(base_dir):
 build_available_subcommands._result = None
 
 
+profile_argument = make_argument(
+    '--profile', metavar='FILE',
+    help='Record the time and memory spent in each build stage, print a '
+         'summary and write a trace to FILE (see chrome://tracing)',
+)
+
+
+webpack_workers_argument = make_argument(
+    '--webpack-workers', metavar='N', type=int,
+    help='Create bundles in up to N parallel processes (default: number of '
+         'CPUs)',
+)
+
+
+@contextmanager
+def profiling(trace_file):
+    if not trace_file:
+        yield
+        return
+
+    from buildtools import profiler
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.write_trace(trace_file)
+        sys.stderr.write(profiler.format_summary() + '\n')
+
+
 @argparse_command(
-    valid_platforms={'chrome', 'gecko', 'edge'},
+    valid_platforms={'chrome', 'gecko', 'edge'}, multi_platform=True,
     arguments=(
         make_argument(
             '-b', '--build-num', dest='build_num',
@@ -141,57 +170,154 @@ build_available_subcommands._result = None
             '-r', '--release', action='store_true',
             help='Create a release build'),
         make_argument('output_file', nargs='?'),
+        profile_argument,
+        webpack_workers_argument,
     ),
 )
 def build(base_dir, build_num, key_file, release, output_file, platform,
-          **kwargs):
+          profile, webpack_workers, **kwargs):
     """
     Create a build.
 
     Creates an extension build with given file name. If output_file is missing
-    a default name will be chosen.
+    a default name will be chosen. When building for multiple platforms at
+    once, default names are always used, the key file is only used to sign
+    the Chrome package, and the input files are only read and hashed once.
     """
-    kwargs = {}
+    if isinstance(platform, basestring):
+        platforms = [platform]
+    else:
+        platforms = platform
+
+    if output_file and len(platforms) > 1:
+        logging.error('An output file can only be given when building for a '
+                      'single platform')
+        return
+
+    from buildtools import profiler
+    from buildtools.packager import FileCache, get_cache_path
+
+    with profiling(profile):
+        cache = FileCache(get_cache_path(base_dir))
+
+        kwargs = {}
+        kwargs['outFile'] = output_file
+        kwargs['releaseBuild'] = release
+        kwargs['buildNum'] = build_num
+        kwargs['cache'] = cache
+        kwargs['webpackWorkers'] = webpack_workers
+
+        for platform in platforms:
+            if platform == 'edge':
+                import buildtools.packagerEdge as packager
+            else:
+                import buildtools.packagerChrome as packager
+
+            # Only Chrome packages are signed with the key file.
+            if len(platforms) > 1 and platform != 'chrome':
+                kwargs['keyFile'] = None
+            else:
+                kwargs['keyFile'] = key_file
+
+            with profiler.stage('build ' + platform):
+                packager.createBuild(base_dir, type=platform, **kwargs)
+
+        with profiler.stage('save cache'):
+            cache.save()
+
+
+def build_devenv(base_dir, platform, cache, **kwargs):
     if platform == 'edge':
         import buildtools.packagerEdge as packager
     else:
         import buildtools.packagerChrome as packager
 
-    kwargs['keyFile'] = key_file
-    kwargs['outFile'] = output_file
-    kwargs['releaseBuild'] = release
-    kwargs['buildNum'] = build_num
+    from buildtools import profiler
+
+    # Only files which changed since the last run are written into the
+    # devenv directory.
+    with profiler.stage('build ' + platform):
+        version = packager.createBuild(base_dir, type=platform, devenv=True,
+                                       releaseBuild=True, cache=cache,
+                                       **kwargs)
+    with profiler.stage('save cache'):
+        cache.save()
+    return version
+
 
-    packager.createBuild(base_dir, type=platform, **kwargs)
+def watch_devenv(base_dir, platform, cache, **kwargs):
+    from buildtools import watcher
+    from buildtools.packager import (get_devenv_sources, getDevEnvPath,
+                                     readMetadata)
+    from buildtools.reloadserver import ReloadServer
+
+    # The devenv is notified about rebuilds by the server, so that it can
+    # reload right away.
+    server = ReloadServer()
+    server.start()
+
+    devenv_dir = getDevEnvPath(base_dir, platform)
+    sources = file_watcher = None
+    try:
+        while True:
+            start_time = time.time()
+            try:
+                # The metadata determine which files have to be watched.
+                metadata = readMetadata(base_dir, platform)
+                if get_devenv_sources(base_dir, metadata) != sources:
+                    if file_watcher:
+                        file_watcher.close()
+                    sources = get_devenv_sources(base_dir, metadata)
+                    file_watcher = watcher.create_watcher(sources)
+                version = build_devenv(base_dir, platform, cache,
+                                       devenvServer=server.url, **kwargs)
+                server.set_version(version)
+                print 'Updated {} in {:.2f}s.'.format(
+                    devenv_dir, time.time() - start_time,
+                )
+            except Exception:
+                if not file_watcher:
+                    raise
+                traceback.print_exc()
+            print 'Watching for changes, press Ctrl+C to stop.'
+            watcher.wait_for_changes(file_watcher)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if file_watcher:
+            file_watcher.close()
+        server.stop()
 
 
 @argparse_command(
     valid_platforms={'chrome', 'gecko', 'edge'},
+    arguments=(
+        make_argument(
+            '-w', '--watch', action='store_true',
+            help='Keep running, and update the development environment '
+                 'whenever source files change'),
+        profile_argument,
+        webpack_workers_argument,
+    ),
 )
-def devenv(base_dir, platform, **kwargs):
+def devenv(base_dir, platform, watch, profile, webpack_workers, **kwargs):
     """
     Set up a development environment.
 
     Will set up or update the devenv folder as an unpacked extension folder '
-    for development.
+    for development. With --watch, it's kept up to date afterwards, reusing
+    the processed files, bundles and webpack processes of previous builds.
     """
-    if platform == 'edge':
-        import buildtools.packagerEdge as packager
-    else:
-        import buildtools.packagerChrome as packager
-
-    file = StringIO()
-    packager.createBuild(base_dir, type=platform, outFile=file, devenv=True,
-                         releaseBuild=True)
-
-    from buildtools.packager import getDevEnvPath
-    devenv_dir = getDevEnvPath(base_dir, platform)
-
-    shutil.rmtree(devenv_dir, ignore_errors=True)
-
-    file.seek(0)
-    with ZipFile(file, 'r') as zip_file:
-        zip_file.extractall(devenv_dir)
+    from buildtools.packager import FileCache, get_cache_path
+
+    with profiling(profile):
+        cache = FileCache(get_cache_path(base_dir))
+        if watch:
+            watch_devenv(base_dir, platform, cache,
+                         webpackWorkers=webpack_workers)
+        else:
+            build_devenv(base_dir, platform, cache,
+                         webpackWorkers=webpack_workers)
 
 
 project_key_argument = make_argument(
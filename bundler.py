@@ -0,0 +1,282 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Bundle CommonJS modules without webpack, for development builds.
+
+Modules are resolved like by webpack_runner.js, i.e. considering aliases,
+the resolve paths and the legacy prefix syntax, and are wrapped into
+functions rather than being transformed. This is much faster than starting
+node and webpack, but only supports require() calls with a string literal.
+"""
+
+import json
+import os
+import posixpath
+import re
+
+INFO_MODULE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           'info.js'))
+
+BASE64_DIGITS = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                 '0123456789+/')
+
+# Comments and string literals are matched as well, so that require() calls
+# within them are skipped.
+TOKEN_REGEX = re.compile(r'''
+    //[^\n]*
+  | /\*.*?\*/
+  | "(?:\\.|[^"\\\n])*"
+  | '(?:\\.|[^'\\\n])*'
+  | `(?:\\.|[^`\\])*`
+  | \brequire\s*\(\s*(?P<quote>["'])
+      (?P<request>(?:\\.|(?!(?P=quote))[^\\\n])*)
+    (?P=quote)\s*\)
+''', re.S | re.X)
+
+PROLOGUE = '''\
+/******/ (function(modules)
+/******/ {
+/******/   var installedModules = {};
+/******/   function load(id)
+/******/   {
+/******/     if (id in installedModules)
+/******/       return installedModules[id].exports;
+/******/     var module = installedModules[id] = {exports: {}};
+/******/     var dependencies = modules[id][1];
+/******/     modules[id][0].call(module.exports, module, module.exports,
+/******/       function(request)
+/******/       {
+/******/         if (!dependencies.hasOwnProperty(request))
+/******/           throw new Error("Cannot find module '" + request + "'");
+/******/         return load(dependencies[request]);
+/******/       });
+/******/     return module.exports;
+/******/   }
+/******/   for (var i = 0; i < {entry_count}; i++)
+/******/     load(i);
+/******/ })([
+'''
+
+EPILOGUE = '''\
+/******/ ]);
+//# sourceMappingURL={map_name}
+'''
+
+
+class BundleError(Exception):
+    pass
+
+
+def encode_vlq(value):
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    result = []
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digit |= 32
+        result.append(BASE64_DIGITS[digit])
+        if not value:
+            return ''.join(result)
+
+
+def find_requires(source):
+    for match in TOKEN_REGEX.finditer(source):
+        if match.group('request') is not None:
+            yield match.group('request')
+
+
+class Resolver(object):
+    """Resolve module requests like webpack_runner.js configures webpack."""
+
+    def __init__(self, resolve_paths, aliases):
+        self.resolve_paths = resolve_paths
+        self.aliases = aliases
+
+    def _load_file(self, path):
+        for candidate in [path, path + '.js', path + '.json']:
+            if os.path.isfile(candidate):
+                return candidate
+        if os.path.isdir(path):
+            for name in ['index.js', 'index.json']:
+                candidate = os.path.join(path, name)
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def _apply_alias(self, request):
+        for alias, target in self.aliases.iteritems():
+            if alias.endswith('$'):
+                if request == alias[:-1]:
+                    return target
+            elif request == alias or request.startswith(alias + '/'):
+                return target + request[len(alias):]
+        return None
+
+    def _resolve(self, request, context, aliased=False):
+        if not aliased:
+            target = self._apply_alias(request)
+            if target is not None:
+                return self.resolve(target, context, aliased=True)
+
+        if os.path.isabs(request):
+            return self._load_file(request)
+        if request == '.' or request.startswith(('./', '../')):
+            return self._load_file(os.path.normpath(
+                os.path.join(context, request),
+            ))
+        for path in self.resolve_paths:
+            result = self._load_file(os.path.join(path, request))
+            if result:
+                return result
+        return None
+
+    def resolve(self, request, context, aliased=False):
+        """Return the path of the module `request` in the directory `context`.
+
+        None is returned if the module can't be found.
+        """
+        # Like the plugin in webpack_runner.js, requests using the legacy
+        # prefix syntax are rewritten first.
+        prefix, underscore, rest = request.partition('_')
+        if underscore and prefix != 'lib':
+            legacy_request = posixpath.normpath(posixpath.join(prefix, rest))
+            result = self._resolve(legacy_request, context, aliased)
+            if result:
+                return result
+        return self._resolve(request, context, aliased)
+
+
+class Bundler(object):
+    def __init__(self, extension_path, info_module, resolver):
+        self.extension_path = extension_path
+        self.info_module = info_module
+        self.resolver = resolver
+
+    def _read_module(self, path):
+        if path == INFO_MODULE:
+            source = self.info_module
+        else:
+            with open(path, 'rb') as file:
+                source = file.read()
+        if path.endswith('.json'):
+            source = 'module.exports = {};\n'.format(source.strip())
+        return source
+
+    def get_name(self, path):
+        relpath = os.path.relpath(path, self.extension_path)
+        relpath = relpath.replace(os.sep, '/')
+        if not relpath.startswith('../'):
+            relpath = './' + relpath
+        return relpath
+
+    def create_bundle(self, bundle_name, entry_points):
+        """Return the bundle, source map and included modules as a tuple.
+
+        The included modules are given as a map of their paths to their size.
+        """
+        modules = []
+        ids = {}
+
+        def add(path):
+            path = os.path.normpath(path)
+            if path not in ids:
+                ids[path] = len(modules)
+                modules.append([path, self._read_module(path), {}])
+            return ids[path]
+
+        for path in entry_points:
+            if not os.path.isfile(path):
+                raise BundleError("Entry module not found: '{}'".format(path))
+            add(path)
+        entry_count = len(modules)
+
+        # Modules are appended while iterating, to process them recursively.
+        for module in modules:
+            path, source, dependencies = module
+            for request in find_requires(source):
+                if request in dependencies:
+                    continue
+                resolved = self.resolver.resolve(request,
+                                                 os.path.dirname(path))
+                if not resolved:
+                    raise BundleError(
+                        "Module not found: Can't resolve '{}' in '{}'".format(
+                            request, os.path.dirname(path),
+                        ),
+                    )
+                dependencies[request] = add(resolved)
+
+        lines = PROLOGUE.replace('{entry_count}',
+                                 str(entry_count)).splitlines()
+        mappings = [''] * len(lines)
+        previous = [0, 0]
+        for index, (path, source, dependencies) in enumerate(modules):
+            lines.append('/* {} */'.format(index))
+            lines.append('[function(module, exports, require)')
+            lines.append('{')
+            mappings.extend(['', '', ''])
+
+            # Every line of the module is mapped to the same line in the
+            # original source.
+            for line_number, line in enumerate(source.splitlines()):
+                lines.append(line)
+                mappings.append('A{}{}A'.format(
+                    encode_vlq(index - previous[0]),
+                    encode_vlq(line_number - previous[1]),
+                ))
+                previous = [index, line_number]
+
+            lines.append('}}, {}],'.format(json.dumps(dependencies,
+                                                      sort_keys=True)))
+            mappings.append('')
+
+        # Bundle names might be unicode, but the bundle must be a byte string.
+        map_name = posixpath.basename(bundle_name).encode('utf-8') + '.map'
+        lines.extend(EPILOGUE.replace('{map_name}', map_name).splitlines())
+        source_map = {
+            'version': 3,
+            'file': bundle_name,
+            'sources': ['webpack:///' + self.get_name(path)
+                        for path, _, _ in modules],
+            'sourcesContent': [source.decode('utf-8')
+                               for _, source, _ in modules],
+            'names': [],
+            'mappings': ';'.join(mappings),
+        }
+
+        included = {path: len(source) for path, source, _ in modules}
+        return ('\n'.join(lines) + '\n', json.dumps(source_map), included)
+
+
+def create_bundles(configuration):
+    """Create the bundles in the given webpack_runner.js configuration.
+
+    Return a map of the bundle file names (and their source maps) to their
+    contents, the included modules (relative to the extension path) and the
+    size of the modules in each bundle.
+    """
+    extension_path = configuration['extension_path']
+    aliases = dict(configuration.get('module_index', {}))
+    aliases.update(configuration['aliases'])
+    resolver = Resolver(configuration['resolve_paths'], aliases)
+    bundler = Bundler(extension_path, configuration['info_module'], resolver)
+
+    files = {}
+    included = set()
+    modules = {}
+    for bundle in configuration['bundles']:
+        name = bundle['bundle_name'].replace(os.sep, '/')
+        data, source_map, bundle_modules = bundler.create_bundle(
+            name, bundle['entry_points'],
+        )
+        files[name] = data
+        files[name + '.map'] = source_map
+
+        modules[name] = {}
+        for path, size in bundle_modules.iteritems():
+            relpath = os.path.relpath(path, extension_path)
+            included.add(relpath)
+            modules[name][relpath] = [size, None]
+    return files, sorted(included), modules
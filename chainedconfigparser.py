@@ -50,12 +50,14 @@ class ChainedConfigParser(ConfigParser.SafeConfigParser):
       option_source(section, option) method is provided to get the path
       of the configuration file defining this option (for relative paths).
       Items returned by the items() function also have a source attribute
-      serving the same purpose.
+      serving the same purpose. The paths of all configuration files which
+      have been read, including inherited ones, are listed by source_files().
     """
 
     def __init__(self):
         ConfigParser.SafeConfigParser.__init__(self)
         self._origin = {}
+        self._source_files = []
 
     def _make_parser(self, filename):
         parser = ConfigParser.SafeConfigParser()
@@ -107,6 +109,8 @@ class ChainedConfigParser(ConfigParser.SafeConfigParser):
 
     def _process_parsers(self, parsers):
         for parser, filename in parsers:
+            if filename not in self._source_files:
+                self._source_files.append(filename)
             for section in parser.sections():
                 if not self.has_section(section):
                     try:
@@ -157,6 +161,9 @@ class ChainedConfigParser(ConfigParser.SafeConfigParser):
                 raise ConfigParser.NoSectionError(section)
             raise ConfigParser.NoOptionError(option, section)
 
+    def source_files(self):
+        return list(self._source_files)
+
     def serialize_section_if_present(self, section, base):
         """Serialize a given section as a dictionary into `base`.
 
@@ -5,13 +5,20 @@
 (function()
 {
   var version = null;
+
+  function getText(url)
+  {
+    return fetch(url, {cache: "no-store"}).then(function(response)
+    {
+      if (!response.ok)
+        throw new Error("Failed to fetch " + url);
+      return response.text();
+    });
+  }
+
   function doPoll()
   {
-    fetch(browser.extension.getURL("devenvVersion__"))
-      .then(function(response)
-      {
-        return response.text();
-      })
+    getText(browser.extension.getURL("devenvVersion__"))
       .then(function(text)
       {
         if (version == null)
@@ -24,6 +31,26 @@
       });
   }
 
-  // Delay first poll to prevent reloading again immediately after a reload
-  doPoll();
+  // When running "build.py devenv --watch", the server given by
+  // devenvServer__ responds once the devenv has been rebuilt. If it's
+  // unavailable, we fall back to polling devenvVersion__.
+  function waitForRebuild(server)
+  {
+    getText(server + "?version=" + encodeURIComponent(version))
+      .then(function(text)
+      {
+        if (text != version)
+          browser.runtime.reload();
+        else
+          waitForRebuild(server);
+      }, doPoll);
+  }
+
+  getText(browser.extension.getURL("devenvVersion__"))
+    .then(function(text)
+    {
+      version = text;
+      return getText(browser.extension.getURL("devenvServer__"));
+    })
+    .then(waitForRebuild, doPoll);
 })();
@@ -7,15 +7,40 @@
 
 import sys
 import os
+import copy
+import glob
 import re
+import shutil
 import subprocess
 import json
+import tempfile
+import hashlib
+import multiprocessing
+import struct
+import threading
+import time
 import zipfile
+import zlib
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 from chainedconfigparser import ChainedConfigParser
 
 import buildtools
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 EXTENSIONS = {
     'edge': 'appx',
     'gecko': 'xpi',
@@ -23,6 +48,25 @@ EXTENSIONS = {
 }
 
 
+# Maximal number of threads used to list directories and read files.
+FILE_READ_THREADS = 8
+
+# Default number of threads used to compress files when creating archives.
+# zlib releases the GIL, so this scales with the number of CPU cores.
+COMPRESSION_THREADS = multiprocessing.cpu_count()
+
+# Size of the chunks files are read and compressed in.
+CHUNK_SIZE = 64 * 1024
+
+# ioctl() request to share the data of one file with another one, on file
+# systems supporting copy-on-write like Btrfs and XFS, see ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+# Uncompressed size and CRC-32 checksum, stored in front of compressed data
+# in the cache.
+COMPRESSED_HEADER = struct.Struct('<QI')
+
+
 def getDefaultFileName(metadata, version, ext):
     return '%s-%s.%s' % (metadata.get('general', 'basename'), version, ext)
 
@@ -58,6 +102,47 @@ def getDevEnvPath(baseDir, type):
     return os.path.join(baseDir, 'devenv.' + type)
 
 
+def get_devenv_sources(base_dir, metadata):
+    """Return the files and directories a devenv is created from.
+
+    Besides the base directory, these are the metadata files (which might
+    inherit from files elsewhere), mapped files and imported locales.
+    """
+    paths = [base_dir] + metadata.source_files()
+    if metadata.has_section('mapping'):
+        for item in metadata.items('mapping'):
+            paths.append(os.path.join(os.path.dirname(item.source),
+                                      *item[1].split('/')))
+    if metadata.has_section('import_locales'):
+        for item in metadata.items('import_locales'):
+            # Everything below the first wildcard could be imported.
+            parts = []
+            for part in item[0].split('/'):
+                if glob.has_magic(part):
+                    break
+                parts.append(part)
+            paths.append(os.path.join(os.path.dirname(item.source), *parts))
+    return paths
+
+
+def get_cache_path(base_dir):
+    """Return the directory of the build cache for the extension `base_dir`.
+
+    The cache is kept outside of the repository, so that it doesn't show up
+    as untracked files. The directory containing the caches of all
+    repositories can be set with the BUILDTOOLS_CACHE_DIR environment
+    variable.
+    """
+    root = os.environ.get('BUILDTOOLS_CACHE_DIR')
+    if not root:
+        user_cache = os.environ.get('XDG_CACHE_HOME')
+        if not user_cache:
+            user_cache = os.path.join(os.path.expanduser('~'), '.cache')
+        root = os.path.join(user_cache, 'adblockplus-buildtools')
+    key = hashlib.sha1(os.path.abspath(base_dir)).hexdigest()[:16]
+    return os.path.join(root, key)
+
+
 def readMetadata(baseDir, type):
     parser = ChainedConfigParser()
     parser.optionxform = lambda option: option
@@ -95,49 +180,746 @@ def getBuildVersion(baseDir, metadata, releaseBuild, buildNum=None):
     return version
 
 
-def getTemplate(template, autoEscape=False):
+def _get_environment(kind, autoescape):
+    # Environments are shared by all builds in this process, so that
+    # templates are only compiled once. Compiled templates are furthermore
+    # cached on disk, so that they don't need to be parsed on every run.
+    key = (kind, autoescape)
+    if key in _get_environment.environments:
+        return _get_environment.environments[key]
+
     import jinja2
 
-    template_path = os.path.join(buildtools.__path__[0], 'templates')
-    loader = jinja2.FileSystemLoader(template_path)
-    if autoEscape:
-        env = jinja2.Environment(loader=loader, autoescape=True)
+    if kind == 'templates':
+        template_path = os.path.join(buildtools.__path__[0], 'templates')
+        loader = jinja2.FileSystemLoader(template_path)
+    else:
+        loader = jinja2.FunctionLoader(_string_templates.get)
+
+    env = jinja2.Environment(loader=loader, autoescape=autoescape,
+                             bytecode_cache=jinja2.FileSystemBytecodeCache())
+    if kind == 'templates':
+        env.filters.update({'json': json.dumps})
+
+    _get_environment.environments[key] = env
+    return env
+
+
+_get_environment.environments = {}
+
+# Sources of templates being compiled by get_string_template(), by their
+# digest.
+_string_templates = {}
+
+
+def getTemplate(template, autoEscape=False):
+    return _get_environment('templates', autoEscape).get_template(template)
+
+
+def get_string_template(source, filename, autoescape=False):
+    """Compile the template given as a string, reusing previous results."""
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    _string_templates[digest] = (source, filename, None)
+    try:
+        return _get_environment('strings', autoescape).get_template(digest)
+    finally:
+        # Compiled templates are kept by the environment, which limits their
+        # number, so the source is only needed until then.
+        del _string_templates[digest]
+
+
+def _translate_pattern(pattern):
+    parts = []
+    for i, part in enumerate(re.split(r'(\*\*/|\*\*|\*|\?)', pattern)):
+        if i % 2 == 0:
+            parts.append(re.escape(part))
+        elif part == '**/':
+            parts.append('(?:.*/)?')
+        elif part == '**':
+            parts.append('.*')
+        elif part == '*':
+            parts.append('[^/]*')
+        else:
+            parts.append('[^/]')
+    return ''.join(parts)
+
+
+def compile_patterns(patterns):
+    """Compile glob patterns for paths into a single regular expression.
+
+    Patterns containing a slash are matched against the full path relative
+    to the package root, other patterns against any part of the path. "*"
+    and "?" match within a name, while "**" may also match slashes. When a
+    pattern matches a directory, it matches everything inside it as well.
+    """
+    regexes = []
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+        if not pattern:
+            continue
+        prefix = '^' if '/' in pattern else '(?:^|/)'
+        regexes.append(prefix + _translate_pattern(pattern) + '(?:/|$)')
+    if not regexes:
+        # Never matches anything.
+        return re.compile(r'(?!)')
+    return re.compile('|'.join('(?:{})'.format(r) for r in regexes))
+
+
+def _get_thread_pool(size=FILE_READ_THREADS):
+    # Pools are shared by all builds in this process, as setting them up and
+    # tearing them down again is fairly slow.
+    if size not in _get_thread_pool.pools:
+        _get_thread_pool.pools[size] = ThreadPool(size)
+    return _get_thread_pool.pools[size]
+
+
+_get_thread_pool.pools = {}
+
+
+def _list_directory(path):
+    """Return the names in a directory, along with whether they are one."""
+    if scandir:
+        return [(entry.name, entry.is_dir()) for entry in scandir(path)]
+    return [(name, os.path.isdir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+
+def _compress(value, compression, cache=None):
+    """Compress a file for a zip archive.
+
+    Return a tuple of the uncompressed size, the CRC-32 checksum and the
+    compressed data. LazyFile handles are read and compressed in chunks.
+    If a FileCache is given, compressed data is reused from previous builds.
+    """
+    if not cache or compression == zipfile.ZIP_STORED:
+        return _compress_uncached(value, compression)[:3]
+
+    if isinstance(value, LazyFile):
+        digest = value.digest
     else:
-        env = jinja2.Environment(loader=loader)
-    env.filters.update({'json': json.dumps})
-    return env.get_template(template)
+        digest = hashlib.sha1(value).hexdigest()
+    result = digest and cache.get_compressed(digest, compression)
+    if not result:
+        # The file might have changed since its digest was calculated, so
+        # the compressed data are stored for the digest of what was read.
+        size, crc, data, digest = _compress_uncached(value, compression)
+        cache.add_compressed(digest, compression, size, crc, data)
+        result = size, crc, data
+    return result
+
+
+def _compress_uncached(value, compression):
+    if compression == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+    else:
+        compressor = None
+
+    if isinstance(value, LazyFile):
+        with open(value.path, 'rb') as file:
+            chunks = iter(lambda: file.read(CHUNK_SIZE), '')
+            return _compress_chunks(chunks, compressor)
+    return _compress_chunks([value], compressor)
+
+
+def _compress_chunks(chunks, compressor):
+    size = 0
+    crc = 0
+    digest = hashlib.sha1()
+    output = []
+    for chunk in chunks:
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        digest.update(chunk)
+        output.append(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        output.append(compressor.flush())
+    return size, crc & 0xffffffff, ''.join(output), digest.hexdigest()
+
+
+def _get_archive_date_time():
+    # See https://reproducible-builds.org/specs/source-date-epoch/
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        timestamp = int(os.environ['SOURCE_DATE_EPOCH'])
+        # Zip archives can't represent any dates before 1980.
+        return max(time.gmtime(timestamp)[:6], (1980, 1, 1, 0, 0, 0))
+    return time.localtime(time.time())[:6]
+
+
+def _write_compressed(zf, zinfo, data):
+    # Equivalent to ZipFile.writestr(), for data which was already compressed.
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    size = max(zinfo.file_size, zinfo.compress_size)
+    zip64 = size > zipfile.ZIP64_LIMIT
+    if zip64 and not zf._allowZip64:
+        raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _clone_file(source, target, hardlink=True):
+    """Create `target` with the contents of `source`, without copying them.
+
+    The file is reflinked if supported by the file system, otherwise it's
+    hardlinked (unless `hardlink` is False). If neither is possible, e.g.
+    across file systems, the file is copied.
+    """
+    if fcntl:
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except (IOError, OSError):
+            if os.path.exists(target):
+                os.remove(target)
+
+    if hardlink:
+        try:
+            os.link(source, target)
+            return
+        except (OSError, AttributeError):
+            pass
+    shutil.copyfile(source, target)
+
+
+def _replace_file(source, target):
+    # On Windows, rename() fails if the target exists.
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+def _materialize(value):
+    if isinstance(value, LazyFile):
+        return value.read()
+    return value
+
+
+class FileCache(object):
+    """Persistent, content-addressed cache for the input files of a build.
+
+    Source files are recorded with their size, modification time and SHA-1
+    digest, so that unchanged files can be recognized without hashing them
+    again. The output of the `process` callback of `Files` is remembered per
+    relative path and `salt`, and is only stored separately if it differs
+    from the input. Bundles are remembered along with the digests of the
+    modules they include.
+    """
+
+    # Files modified more recently than this (in seconds) are not recorded,
+    # since further changes within the resolution of the file system's
+    # timestamps would go unnoticed.
+    MIN_AGE = 2
+
+    # Number of differently salted results to remember for every file, e.g.
+    # one for each platform the extension is built for.
+    MAX_SALTS = 4
+
+    # Compressed data, bundles and webpack caches which haven't been used for
+    # this long (in seconds) are removed from the cache.
+    UNUSED_MAX_AGE = 7 * 24 * 60 * 60
+
+    # Other builds sharing the cache might still use data (in seconds) which
+    # isn't referenced by the index yet, or anymore. Objects are marked as
+    # used by updating their modification time.
+    IN_USE_MAX_AGE = 60 * 60
+
+    TEMP_SUFFIX = '.tmp'
+
+    def __init__(self, path, salt=''):
+        self.path = path
+        self.salt = salt
+        self._index_path = os.path.join(path, 'index.json')
+        self._lock_path = os.path.join(path, 'index.lock')
+        self._objects_path = os.path.join(path, 'objects')
+        self._compressed_path = os.path.join(path, 'compressed')
+        # webpack_runner.js caches each bundle configuration in a directory
+        # of its own, and updates its modification time whenever it is used.
+        self.webpack_path = os.path.join(path, 'webpack')
+        # Compressed data is looked up and added from multiple threads.
+        self._compressed_lock = threading.Lock()
+        self._recent = {}
+
+        self._files = {}
+        self._processed = {}
+        self._compressed = {}
+        self._bundles = {}
+        self._module_indexes = {}
+        self._merge_index()
+
+    def salted(self, salt):
+        """Return a cache sharing all data with this one, but a new salt.
+
+        This is used to share a cache between the builds for multiple
+        platforms in the same process.
+        """
+        result = copy.copy(self)
+        result.salt = salt
+        return result
+
+    def get_digest(self, path, stat):
+        """Return the known digest for the file at `path`, or None."""
+        entry = self._files.get(path) or self._recent.get(path)
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime]:
+            return entry[2]
+        return None
+
+    def add(self, path, stat, digest):
+        """Record the digest of the file at `path`."""
+        entry = [stat.st_size, stat.st_mtime, digest]
+        if time.time() - stat.st_mtime >= self.MIN_AGE:
+            self._files[path] = entry
+        else:
+            # Recently modified files can still be recognized for the rest
+            # of this process, just not by later runs.
+            self._recent[path] = entry
+
+    def digest_file(self, path):
+        """Return the digest of the file at `path`, reading it if necessary.
+
+        None is returned if the file doesn't exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        digest = self.get_digest(path, stat)
+        if digest is None:
+            with open(path, 'rb') as file:
+                digest = hashlib.sha1(file.read()).hexdigest()
+            self.add(path, stat, digest)
+        return digest
+
+    def object_path(self, digest):
+        return os.path.join(self._objects_path, digest)
+
+    def _write_file(self, directory, path, data):
+        # Write to a temporary file first, so that other threads or processes
+        # never see incomplete data.
+        fd, temp_path = tempfile.mkstemp(dir=directory,
+                                         suffix=self.TEMP_SUFFIX)
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in data:
+                file.write(chunk)
+        _replace_file(temp_path, path)
+
+    def _add_object(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        if not os.path.isdir(self._objects_path):
+            os.makedirs(self._objects_path)
+        self._write_file(self._objects_path, self.object_path(digest), [data])
+        return digest
+
+    def _use_object(self, digest):
+        """Mark the object as used, return whether it exists."""
+        try:
+            os.utime(self.object_path(digest), None)
+        except OSError:
+            return False
+        return True
+
+    def get_processed(self, relpath, digest):
+        """Look up the digest of the processed contents of a file.
+
+        The processed contents can be found at object_path() of the returned
+        digest, unless it equals `digest`, i.e. processing left the file
+        unchanged. None is returned if nothing is known about the file.
+        """
+        for salt, source_digest, result_digest in self._processed.get(
+                relpath, []):
+            if salt != self.salt or source_digest != digest:
+                continue
+            if result_digest == digest:
+                return result_digest
+            if self._use_object(result_digest):
+                return result_digest
+            break
+        return None
+
+    def add_processed(self, relpath, digest, data):
+        """Remember the processed contents of a file."""
+        result_digest = hashlib.sha1(data).hexdigest()
+        if result_digest != digest:
+            self._add_object(data)
+
+        entries = [entry for entry in self._processed.get(relpath, [])
+                   if entry[0] != self.salt]
+        entries.insert(0, [self.salt, digest, result_digest])
+        self._processed[relpath] = entries[:self.MAX_SALTS]
+        return result_digest
+
+    def _compressed_key(self, digest, compression):
+        return '{}.{}'.format(digest, compression)
+
+    def get_compressed(self, digest, compression):
+        """Look up the compressed data for the given contents.
+
+        Return a tuple of the uncompressed size, the CRC-32 checksum and the
+        compressed data, or None if nothing is known about the contents.
+        """
+        key = self._compressed_key(digest, compression)
+        with self._compressed_lock:
+            if key not in self._compressed:
+                return None
+            self._compressed[key] = time.time()
+
+        try:
+            with open(os.path.join(self._compressed_path, key), 'rb') as file:
+                header = file.read(COMPRESSED_HEADER.size)
+                size, crc = COMPRESSED_HEADER.unpack(header)
+                return size, crc, file.read()
+        except (IOError, struct.error):
+            return None
+
+    def add_compressed(self, digest, compression, size, crc, data):
+        """Remember the compressed data for the given contents."""
+        key = self._compressed_key(digest, compression)
+        with self._compressed_lock:
+            if not os.path.isdir(self._compressed_path):
+                os.makedirs(self._compressed_path)
+
+        self._write_file(self._compressed_path,
+                         os.path.join(self._compressed_path, key),
+                         [COMPRESSED_HEADER.pack(size, crc), data])
+
+        with self._compressed_lock:
+            self._compressed[key] = time.time()
+
+    def get_bundles(self, key):
+        """Look up the bundles created for the bundler configuration `key`.
+
+        Return a tuple of the map of included files to their digests, as they
+        were when the bundles were created, the map of bundle file names to
+        LazyFile handles and the module sizes given to add_bundles(). None is
+        returned if nothing is known about `key`.
+        """
+        entry = self._bundles.get(key)
+        if not entry:
+            return None
+
+        outputs = {}
+        for name, digest in entry['files'].iteritems():
+            if not self._use_object(digest):
+                return None
+            outputs[name] = LazyFile(self.object_path(digest), digest)
+        entry['last_used'] = time.time()
+        return entry['included'], outputs, entry.get('modules')
+
+    def _move_object(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), ''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        if not os.path.isdir(self._objects_path):
+            os.makedirs(self._objects_path)
+        # The bundles are written into the cache directory, so that they can
+        # be moved atomically.
+        _replace_file(path, self.object_path(digest))
+        return digest
+
+    def add_bundles(self, key, included, outputs, modules=None):
+        """Remember the bundles created for the bundler configuration `key`.
+
+        `included` maps the files included in the bundles to their digests,
+        `outputs` maps the bundle file names to the files they were written
+        to, which are moved into the cache. `modules` are the sizes of the
+        modules in each bundle, if known. Return the map of bundle file
+        names to LazyFile handles, like get_bundles().
+        """
+        files = {name: self._move_object(path)
+                 for name, path in outputs.iteritems()}
+        self._bundles[key] = {
+            'included': included,
+            'files': files,
+            'modules': modules,
+            'last_used': time.time(),
+        }
+        return {name: LazyFile(self.object_path(digest), digest)
+                for name, digest in files.iteritems()}
+
+    def get_module_index(self, roots):
+        """Look up the module index for the given root directories.
+
+        None is returned unless an index was added, and none of the scanned
+        directories changed since.
+        """
+        entry = self._module_indexes.get(json.dumps(roots))
+        if not entry:
+            return None
+
+        for path, mtime in entry['directories'].iteritems():
+            try:
+                current_mtime = os.stat(path).st_mtime
+            except OSError:
+                current_mtime = None
+            if current_mtime != mtime:
+                return None
+        entry['last_used'] = time.time()
+        return entry['index']
+
+    def add_module_index(self, roots, directories, index):
+        """Remember the module index for the given root directories.
+
+        `directories` maps the scanned directories to their modification
+        time (None for missing directories).
+        """
+        # Like with files, further changes to recently modified directories
+        # could go unnoticed.
+        recent = time.time() - self.MIN_AGE
+        if any(mtime > recent for mtime in directories.itervalues()):
+            return
+
+        self._module_indexes[json.dumps(roots)] = {
+            'directories': directories,
+            'index': index,
+            'last_used': time.time(),
+        }
+
+    def _merge_index(self):
+        """Add the entries of the index on disk, e.g. saved by another build.
+
+        Entries known to this instance take precedence, unless they were
+        used less recently.
+        """
+        try:
+            with open(self._index_path, 'rb') as file:
+                index = json.load(file)
+        except (IOError, ValueError):
+            return
+
+        for path, entry in index.get('files', {}).iteritems():
+            self._files.setdefault(path, entry)
+        for relpath, entries in index.get('processed', {}).iteritems():
+            merged = self._processed.setdefault(relpath, [])
+            salts = {entry[0] for entry in merged}
+            merged.extend(entry for entry in entries if entry[0] not in salts)
+            del merged[self.MAX_SALTS:]
+        for key, last_used in index.get('compressed', {}).iteritems():
+            if last_used > self._compressed.get(key, 0):
+                self._compressed[key] = last_used
+        for entries, saved in [(self._bundles, index.get('bundles', {})),
+                               (self._module_indexes,
+                                index.get('module_indexes', {}))]:
+            for key, entry in saved.iteritems():
+                if key not in entries:
+                    entries[key] = entry
+                elif entries[key]['last_used'] < entry['last_used']:
+                    entries[key] = entry
+
+    def save(self):
+        """Write the index to disk, and remove stale cached data.
+
+        The index is merged with the one on disk, since other builds might
+        share the cache.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with open(self._lock_path, 'ab') as lock_file:
+            # The lock is released when the file is closed.
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._merge_index()
+            self._save()
+
+    def _save(self):
+        expired = time.time() - self.UNUSED_MAX_AGE
+        for key, last_used in self._compressed.items():
+            if last_used < expired:
+                del self._compressed[key]
+        for entries in [self._bundles, self._module_indexes]:
+            for key, entry in entries.items():
+                if entry['last_used'] < expired:
+                    del entries[key]
+
+        index = {'files': self._files, 'processed': self._processed,
+                 'compressed': self._compressed, 'bundles': self._bundles,
+                 'module_indexes': self._module_indexes}
+        self._write_file(self.path, self._index_path, [json.dumps(index)])
+
+        # Unreferenced data is only removed once it hasn't been used for a
+        # while, since other builds might not have saved their index yet.
+        recent = time.time() - self.IN_USE_MAX_AGE
+        referenced = {entry[2] for entries in self._processed.values()
+                      for entry in entries}
+        referenced.update(digest for entry in self._bundles.values()
+                          for digest in entry['files'].values())
+        referenced.update(self._compressed)
+        for directory in [self._objects_path, self._compressed_path]:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name in referenced:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < recent:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+        if os.path.isdir(self.webpack_path):
+            for name in os.listdir(self.webpack_path):
+                path = os.path.join(self.webpack_path, name)
+                try:
+                    if os.path.getmtime(path) < expired:
+                        shutil.rmtree(path)
+                except OSError:
+                    pass
+
+
+class LazyFile(object):
+    """Contents of a file on disk, which are only read when needed.
+
+    The SHA-1 `digest` of the contents is given if it is already known.
+    """
+
+    def __init__(self, path, digest=None):
+        self.path = path
+        self.digest = digest
+
+    def read(self):
+        with open(self.path, 'rb') as file:
+            return file.read()
 
 
 class Files(dict):
-    def __init__(self, includedFiles, ignoredFiles, process=None):
+    """Map of file names in the package to their contents.
+
+    Files read from disk are kept as LazyFile handles, unless processing
+    changed their contents, and are only loaded when accessed. Handles
+    returned by pop() can be assigned to another name without loading them.
+    """
+
+    def __init__(self, includedFiles, ignoredFiles, process=None, cache=None):
         self.includedFiles = includedFiles
         self.ignoredFiles = ignoredFiles
         self.process = process
+        self.cache = cache
+        self._ignored_regex = compile_patterns(ignoredFiles)
+
+    def __getitem__(self, key):
+        return _materialize(dict.__getitem__(self, key))
 
     def __setitem__(self, key, value):
         if self.process:
-            value = self.process(key, value)
+            value = self.process(key, _materialize(value))
         dict.__setitem__(self, key, value)
 
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def iteritems(self):
+        for key, value in dict.iteritems(self):
+            yield key, _materialize(value)
+
+    def itervalues(self):
+        for value in dict.itervalues(self):
+            yield _materialize(value)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
     def isIncluded(self, relpath):
         return relpath.split('/')[0] in self.includedFiles
 
     def is_ignored(self, relpath):
-        parts = relpath.split('/')
-        return any(part in self.ignoredFiles for part in parts)
+        return self._ignored_regex.search(relpath) is not None
 
     def read(self, path, relpath='', skip=()):
-        if os.path.isdir(path):
-            for file in os.listdir(path):
-                name = relpath + ('/' if relpath != '' else '') + file
-                included = self.isIncluded(name) and not self.is_ignored(name)
-                if name not in skip and included:
-                    self.read(os.path.join(path, file), name, skip)
-        else:
+        if not os.path.isdir(path):
+            self._store(path, relpath, self._load(path, relpath))
+            return
+
+        pool = _get_thread_pool()
+        found = self._walk(pool, path, relpath, skip)
+        loaded = pool.imap(lambda args: self._load(*args), found)
+        for (filepath, name), result in izip(found, loaded):
+            self._store(filepath, name, result)
+
+    def _walk(self, pool, path, relpath, skip):
+        # Directories are listed in parallel, one level of the tree at a time.
+        # Ignored directories are pruned, and inclusion only depends on the
+        # top-level name, so it doesn't need to be checked for their contents.
+        if relpath != '' and not self.isIncluded(relpath):
+            return []
+
+        result = []
+        directories = [(path, relpath)]
+        while directories:
+            listings = pool.map(_list_directory,
+                                [dirpath for dirpath, _ in directories])
+            subdirectories = []
+            for (dirpath, dirname), entries in zip(directories, listings):
+                for file, is_dir in entries:
+                    if dirname == '':
+                        if file not in self.includedFiles:
+                            continue
+                        name = file
+                    else:
+                        name = dirname + '/' + file
+                    if name not in skip and not self.is_ignored(name):
+                        target = subdirectories if is_dir else result
+                        target.append((os.path.join(dirpath, file), name))
+            directories = subdirectories
+        return result
+
+    def _load(self, path, relpath):
+        # Called on worker threads, hence this must not modify any state.
+        if not self.cache:
+            if not self.process:
+                return None, None, True, LazyFile(path)
             with open(path, 'rb') as file:
-                if relpath in self:
-                    print >>sys.stderr, 'Warning: File %s defined multiple times' % relpath
-                self[relpath] = file.read()
+                return None, None, False, file.read()
+
+        stat = os.stat(path)
+        digest = self.cache.get_digest(path, stat)
+        if digest and not self.process:
+            return stat, digest, True, LazyFile(path, digest)
+        if digest:
+            result_digest = self.cache.get_processed(relpath, digest)
+            if result_digest == digest:
+                return stat, digest, True, LazyFile(path, digest)
+            if result_digest:
+                lazy = LazyFile(self.cache.object_path(result_digest),
+                                result_digest)
+                return stat, digest, True, lazy
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        return stat, hashlib.sha1(data).hexdigest(), False, data
+
+    def _store(self, path, relpath, loaded):
+        stat, digest, known, data = loaded
+        if relpath in self:
+            print >>sys.stderr, 'Warning: File %s defined multiple times' % relpath
+
+        if not known:
+            if self.cache:
+                self.cache.add(path, stat, digest)
+            if self.process:
+                processed = self.process(relpath, data)
+                if self.cache:
+                    self.cache.add_processed(relpath, digest, processed)
+                # Keep unchanged files on disk rather than in memory.
+                if processed != data:
+                    data = processed
+                else:
+                    data = LazyFile(path, digest)
+            else:
+                data = LazyFile(path, digest)
+        dict.__setitem__(self, relpath, data)
 
     def readMappedFiles(self, mappings):
         for item in mappings:
@@ -154,20 +936,124 @@ class Files(dict):
                 print >>sys.stderr, "Warning: Mapped file %s doesn't exist" % source
 
     def preprocess(self, filenames, params={}):
-        import jinja2
-        env = jinja2.Environment()
-
         for filename in filenames:
-            env.autoescape = os.path.splitext(filename)[1].lower() in ('.html', '.xml')
-            template = env.from_string(self[filename].decode('utf-8'))
+            extension = os.path.splitext(filename)[1].lower()
+            autoescape = extension in ('.html', '.xml')
+            template = get_string_template(self[filename].decode('utf-8'),
+                                           filename, autoescape)
             self[filename] = template.render(params).encode('utf-8')
 
-    def zip(self, outFile, sortKey=None, compression=zipfile.ZIP_DEFLATED):
+    def zip(self, outFile, sortKey=None, compression=zipfile.ZIP_DEFLATED,
+            threads=None):
+        names = sorted(self, key=sortKey)
+        date_time = _get_archive_date_time()
+
+        # Files are compressed in parallel, a batch at a time in order to
+        # limit how much compressed data is kept in memory. Since each file
+        # is compressed independently, the result doesn't depend on the
+        # number of threads.
+        threads = threads or COMPRESSION_THREADS
+        if threads > 1:
+            compress_batch = _get_thread_pool(threads).map
+        else:
+            compress_batch = map
+        batch_size = threads * 4
+
         with zipfile.ZipFile(outFile, 'w', compression) as zf:
-            for name in sorted(self, key=sortKey):
-                zf.writestr(name, self[name])
+            for i in range(0, len(names), batch_size):
+                batch = names[i:i + batch_size]
+                compressed = compress_batch(
+                    lambda name: _compress(dict.__getitem__(self, name),
+                                           compression, self.cache),
+                    batch,
+                )
+                for name, (size, crc, data) in zip(batch, compressed):
+                    zinfo = zipfile.ZipInfo(name, date_time)
+                    zinfo.compress_type = compression
+                    zinfo.external_attr = 0o600 << 16
+                    zinfo.file_size = size
+                    zinfo.CRC = crc
+                    zinfo.compress_size = len(data)
+                    _write_compressed(zf, zinfo, data)
 
     def zipToString(self, sortKey=None):
         buffer = StringIO()
         self.zip(buffer, sortKey=sortKey)
         return buffer.getvalue()
+
+    def get_digest(self, name):
+        """Return the SHA-1 digest of the contents of the file `name`."""
+        value = dict.__getitem__(self, name)
+        if isinstance(value, LazyFile) and value.digest:
+            return value.digest
+        return hashlib.sha1(_materialize(value)).hexdigest()
+
+    def _is_cached(self, path):
+        return bool(self.cache) and path.startswith(
+            os.path.join(self.cache.path, ''),
+        )
+
+    def _digest_on_disk(self, path):
+        if self.cache:
+            return self.cache.digest_file(path)
+        try:
+            with open(path, 'rb') as file:
+                return hashlib.sha1(file.read()).hexdigest()
+        except IOError:
+            return None
+
+    def write_directory(self, path):
+        """Write the files into the directory `path`, e.g. a devenv.
+
+        Rather than recreating the directory, only files whose contents
+        differ from the ones on disk are written, and only files which aren't
+        in the map anymore are removed. Source files which haven't been
+        modified by the build are reflinked or hardlinked rather than copied,
+        hence hardlinked files must not be modified in place. Return the
+        names of written files.
+        """
+        existing = set()
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                relpath = os.path.relpath(os.path.join(dirpath, filename),
+                                          path)
+                existing.add(relpath.replace(os.sep, '/'))
+
+        for name in existing.difference(self):
+            os.remove(os.path.join(path, *name.split('/')))
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            if dirpath != path and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+        written = []
+        for name in sorted(self):
+            value = dict.__getitem__(self, name)
+            digest = self.get_digest(name)
+            target = os.path.join(path, *name.split('/'))
+            if name in existing and self._digest_on_disk(target) == digest:
+                continue
+
+            directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Replace files atomically, so that the browser never sees
+            # incomplete files when reloading the extension. The temporary
+            # file gets a unique name, not to clash with any file in the map,
+            # but is created below, e.g. as a hardlink.
+            fd, temp_path = tempfile.mkstemp(dir=directory,
+                                             suffix=FileCache.TEMP_SUFFIX)
+            os.close(fd)
+            os.remove(temp_path)
+            if isinstance(value, LazyFile):
+                # Processed files and bundles are stored in the cache, which
+                # might overwrite them, so only source files are hardlinked.
+                _clone_file(value.path, temp_path,
+                            hardlink=not self._is_cached(value.path))
+            else:
+                with open(temp_path, 'wb') as file:
+                    file.write(value)
+            _replace_file(temp_path, target)
+            if self.cache:
+                self.cache.add(target, os.stat(target), digest)
+            written.append(name)
+        return written
@@ -2,27 +2,44 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import atexit
 import ConfigParser
 import errno
 import glob
+import hashlib
 import io
 import json
+import multiprocessing
 import os
 import re
+import select
+import shutil
 import struct
 import subprocess
 import sys
-import random
+import tempfile
+import time
+import zlib
 import posixpath
+from multiprocessing.pool import ThreadPool
 
+import bundler
+import profiler
 from packager import (readMetadata, getDefaultFileName, getBuildVersion,
-                      getTemplate, get_extension, Files, get_app_id)
+                      getTemplate, get_extension, Files, FileCache,
+                      get_app_id, get_cache_path, getDevEnvPath,
+                      _replace_file)
 
 defaultLocale = 'en_US'
 
 
 def getIgnoredFiles(params):
-    return {'store.description'}
+    result = {'store.description'}
+
+    metadata = params['metadata']
+    if metadata.has_section('exclude'):
+        result.update(metadata.options('exclude'))
+    return result
 
 
 def getPackageFiles(params):
@@ -61,11 +78,12 @@ def makeIcons(files, filenames):
     return icons
 
 
-def createScriptPage(params, template_name, script_option):
+def createScriptPage(params, template_name, script_option, base=''):
     template = getTemplate(template_name, autoEscape=True)
+    scripts = params['metadata'].get(*script_option).split()
     return template.render(
         basename=params['metadata'].get('general', 'basename'),
-        scripts=params['metadata'].get(*script_option).split(),
+        scripts=add_shared_bundle(params, scripts, base),
     ).encode('utf-8')
 
 
@@ -107,8 +125,9 @@ def createManifest(params, files):
                                           metadata.get('general', 'icons').split())
 
     if metadata.has_option('general', 'backgroundScripts'):
-        templateData['backgroundScripts'] = metadata.get(
-            'general', 'backgroundScripts').split()
+        templateData['backgroundScripts'] = add_shared_bundle(
+            params, metadata.get('general', 'backgroundScripts').split(),
+        )
         if params['devenv']:
             templateData['backgroundScripts'].append('devenvPoller__.js')
 
@@ -119,7 +138,7 @@ def createManifest(params, files):
                 continue
             contentScripts.append({
                 'matches': ['http://*/*', 'https://*/*'],
-                'js': scripts.split(),
+                'js': add_shared_bundle(params, scripts.split()),
                 'run_at': run_at,
                 'all_frames': True,
                 'match_about_blank': True,
@@ -149,7 +168,601 @@ def toJson(data):
     ).encode('utf-8') + '\n'
 
 
+WEBPACK_RUNNER = os.path.join(os.path.dirname(__file__), 'webpack_runner.js')
+
+# Default maximal number of webpack_runner.js processes creating bundles in
+# parallel.
+WEBPACK_WORKERS = multiprocessing.cpu_count()
+
+
+class WebpackError(Exception):
+    pass
+
+
+class WebpackWorker(object):
+    """Long-lived node process producing bundles with webpack_runner.js.
+
+    Starting node and loading webpack takes much longer than producing the
+    bundles, so the same process is reused for all builds. Requests and
+    responses are exchanged as one line of JSON each, over the process' STDIN
+    and STDOUT. The process is (re)started as necessary, if it isn't running
+    or doesn't respond to a ping.
+    """
+
+    PING_TIMEOUT = 30
+
+    COMMAND = ['node', WEBPACK_RUNNER, '--server']
+
+    def __init__(self):
+        self._process = None
+        self._last_id = 0
+
+    def _start(self):
+        # Responses can be large, so STDOUT must be buffered.
+        self._process = subprocess.Popen(self.COMMAND, bufsize=-1,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            try:
+                # Closing STDIN lets the worker exit once it's idle.
+                self._process.stdin.close()
+            except IOError:
+                pass
+            if self._process.poll() is None:
+                self._process.terminate()
+        self._process.wait()
+        self._process = None
+
+    def _request(self, request, timeout=None):
+        self._last_id += 1
+        request['id'] = self._last_id
+        self._process.stdin.write(json.dumps(request) + '\n')
+        self._process.stdin.flush()
+
+        stdout = self._process.stdout
+        if timeout is not None and os.name == 'posix':
+            if not select.select([stdout], [], [], timeout)[0]:
+                raise WebpackError('webpack_runner.js did not respond')
+        line = stdout.readline()
+        if not line:
+            raise IOError(errno.EPIPE, 'webpack_runner.js exited')
+
+        response = json.loads(line)
+        if response['id'] != request['id']:
+            raise WebpackError('Unexpected response from webpack_runner.js')
+        if 'error' in response:
+            raise WebpackError(response['error'])
+        return response['result']
+
+    def is_healthy(self):
+        if self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            return self._request({'type': 'ping'}, self.PING_TIMEOUT) == 'pong'
+        except (IOError, ValueError, KeyError, WebpackError):
+            return False
+
+    def run(self, configuration):
+        for attempt in range(2):
+            if not self.is_healthy():
+                self.stop()
+                self._start()
+            try:
+                return self._request({'type': 'build',
+                                      'configuration': configuration})
+            except (IOError, ValueError):
+                # The worker crashed, or wrote garbage. Retry once with a
+                # fresh process before giving up.
+                self.stop()
+        raise WebpackError('webpack_runner.js exited unexpectedly')
+
+
+def get_webpack_workers(count):
+    workers = get_webpack_workers.workers
+    while len(workers) < count:
+        worker = WebpackWorker()
+        atexit.register(worker.stop)
+        workers.append(worker)
+    return workers[:count]
+
+
+get_webpack_workers.workers = []
+
+
+def run_webpack_workers(configuration, workers=None):
+    """Create the bundles, distributed over up to `workers` processes.
+
+    Return the output of webpack_runner.js, merged for all processes.
+    """
+    bundles = configuration['bundles']
+    count = max(1, min(workers or WEBPACK_WORKERS, len(bundles)))
+    if 'shared_bundle' in configuration:
+        # Bundles sharing a bundle must be created by the same compiler.
+        count = 1
+    workers = get_webpack_workers(count)
+    if count == 1:
+        return workers[0].run(configuration)
+
+    jobs = [(worker, dict(configuration, bundles=bundles[i::count]))
+            for i, worker in enumerate(workers)]
+    pool = ThreadPool(count)
+    try:
+        outputs = pool.map(lambda job: job[0].run(job[1]), jobs)
+    finally:
+        pool.close()
+
+    files = []
+    included = set()
+    modules = {}
+    for output in outputs:
+        files.extend(output['files'])
+        included.update(output['included'])
+        modules.update(output.get('modules', {}))
+    result = {'files': files, 'included': sorted(included)}
+    if configuration.get('report'):
+        result['modules'] = modules
+    return result
+
+
+def get_bundles_cache_key(configuration):
+    key = hashlib.sha1(json.dumps(configuration, sort_keys=True))
+
+    # The bundles also depend on the bundler itself, and on which modules can
+    # be found in the resolve paths, e.g. if a new module shadows another.
+    for path in [WEBPACK_RUNNER,
+                 os.path.join(os.path.dirname(__file__), 'info-loader.js')]:
+        with open(path, 'rb') as file:
+            key.update(file.read())
+    for path in configuration['resolve_paths']:
+        try:
+            key.update(json.dumps(sorted(os.listdir(path))))
+        except OSError:
+            key.update('null')
+    return key.hexdigest()
+
+
+def get_cached_bundles(cache, key, extension_path):
+    cached = cache.get_bundles(key)
+    if not cached:
+        return None
+
+    included, outputs, modules = cached
+    for relpath, digest in included.iteritems():
+        path = os.path.join(extension_path, relpath)
+        if cache.digest_file(path) != digest:
+            return None
+    return list(included), outputs, modules
+
+
+def get_module_digests(cache, extension_path, included, start_time):
+    """Return the digests of the modules included in bundles, or None.
+
+    Modules might have been bundled with their previous contents if they
+    were modified after `start_time` (when the bundler started), within the
+    resolution of file system timestamps. In that case None is returned,
+    and the bundles must not be cached.
+    """
+    recent = start_time - cache.MIN_AGE
+    digests = {}
+    for relpath in included:
+        path = os.path.join(extension_path, relpath)
+        digests[relpath] = cache.digest_file(path)
+        # Checked after calculating the digest, to detect changes since.
+        try:
+            if os.stat(path).st_mtime >= recent:
+                return None
+        except OSError:
+            return None
+    return digests
+
+
+def run_webpack(configuration, cache=None, key=None, workers=None):
+    """Create the bundles, using up to `workers` webpack processes.
+
+    Return the included modules, the bundles and (if requested with the
+    "report" option) the sizes of the modules in each bundle. The bundles
+    are written to a temporary directory, rather than passed through the
+    output of webpack_runner.js. If a cache is given they are moved into the
+    cache (as bundles for `key`) and returned as LazyFile handles, unless
+    modules changed in the meantime. Otherwise they are read into memory.
+    """
+    start_time = time.time()
+    if cache:
+        if not os.path.isdir(cache.path):
+            os.makedirs(cache.path)
+        output_path = tempfile.mkdtemp(dir=cache.path)
+    else:
+        output_path = tempfile.mkdtemp()
+
+    try:
+        output = run_webpack_workers(dict(configuration,
+                                          output_path=output_path), workers)
+        included = output['included']
+        modules = output.get('modules')
+        paths = {name: os.path.join(output_path, name)
+                 for name in output['files']}
+
+        if cache:
+            digests = get_module_digests(cache,
+                                         configuration['extension_path'],
+                                         included, start_time)
+            if digests is not None:
+                return included, cache.add_bundles(key, digests, paths,
+                                                   modules), modules
+
+        outputs = {}
+        for name, path in paths.iteritems():
+            with open(path, 'rb') as file:
+                outputs[name] = file.read()
+        return included, outputs, modules
+    finally:
+        shutil.rmtree(output_path)
+
+
+def get_bundle_options(params):
+    """Return the options for creating the bundles of the given build.
+
+    Release builds use the settings in the [bundle_release] section of the
+    metadata, if any. By default, the bundles are minified and module
+    concatenation (scope hoisting) is used, while the source maps are
+    written to a separate file rather than the package.
+    """
+    metadata = params['metadata']
+    release = params['releaseBuild'] and not params['devenv']
+    if not release or not metadata.has_section('bundle_release'):
+        return {
+            'minify': False,
+            'concatenate_modules': False,
+            'source_maps': 'package',
+        }
+
+    options = {
+        'minify': True,
+        'concatenate_modules': True,
+        'source_maps': 'separate',
+    }
+    for key, option in [('minify', 'minify'),
+                        ('concatenate_modules', 'concatenateModules')]:
+        if metadata.has_option('bundle_release', option):
+            options[key] = metadata.getboolean('bundle_release', option)
+    if metadata.has_option('bundle_release', 'sourceMaps'):
+        options['source_maps'] = metadata.get('bundle_release', 'sourceMaps')
+        if options['source_maps'] not in {'package', 'separate', 'none'}:
+            raise Exception('Invalid value for sourceMaps: {}'.format(
+                options['source_maps'],
+            ))
+    return options
+
+
+def get_source_maps_file_name(package_file):
+    return os.path.splitext(package_file)[0] + '-sourcemaps.zip'
+
+
+def write_source_maps(package_file, source_maps):
+    """Write source maps which aren't part of the package into a ZIP file.
+
+    The file is created next to the package, unless the package isn't written
+    to a file name.
+    """
+    if not source_maps or not isinstance(package_file, basestring):
+        return
+
+    files = Files(set(), set())
+    files.update(source_maps)
+    files.zip(get_source_maps_file_name(package_file))
+
+
+def has_bundle_report(params):
+    metadata = params['metadata']
+    return any(metadata.has_section(section)
+               for section in ['bundle_report', 'bundle_budgets'])
+
+
+def get_compressed_size(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                  zlib.DEFLATED, -15)
+    return len(compressor.compress(data)) + len(compressor.flush())
+
+
+def create_bundle_report(files, modules):
+    """Break down the size of each bundle by the modules it consists of.
+
+    Sizes of bundles are those of their contents in the package, i.e. after
+    minification for optimized release builds. Sizes of modules are those of
+    their source code in the bundle, as reported by webpack. Compressed
+    sizes are those of the data compressed with DEFLATE.
+    """
+    report = {}
+    for bundle, bundle_modules in modules.iteritems():
+        data = files[bundle]
+        report[bundle] = {
+            'size': len(data),
+            'compressed': get_compressed_size(data),
+            'modules': {
+                name: {'size': size, 'compressed': compressed}
+                for name, (size, compressed) in bundle_modules.iteritems()
+            },
+        }
+    return report
+
+
+def parse_size(value):
+    """Parse a number of bytes, with an optional k (KiB) or M (MiB) suffix."""
+    value = value.strip()
+    for suffix, factor in [('k', 1024), ('M', 1024 * 1024)]:
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+def describe_module_changes(entry, previous, count=3):
+    changes = []
+    for name, module in entry['modules'].iteritems():
+        size = module['compressed'] or module['size']
+        old_module = previous.get('modules', {}).get(name)
+        if old_module:
+            size -= old_module['compressed'] or old_module['size']
+        if size > 0:
+            changes.append((size, name))
+    changes.sort(reverse=True)
+    return ', '.join('{} +{}'.format(name, size)
+                     for size, name in changes[:count])
+
+
+def check_bundle_report(params, report):
+    """Check the bundle sizes against the budgets given in the metadata.
+
+    The compressed size of the bundles listed in the [bundle_budgets] section
+    must not exceed the given budget. If a baseline (a report from an
+    earlier build) and maxGrowth (in percent) are given in the
+    [bundle_report] section, the compressed size of any bundle must not grow
+    any further than that.
+    Depending on the action option, exceeding a budget either raises an
+    exception (error, the default) or prints a warning (warn).
+
+    This is only done for minified release builds, since the bundles of
+    other builds are much larger.
+    """
+    metadata = params['metadata']
+    problems = []
+
+    if metadata.has_section('bundle_budgets'):
+        for bundle, budget in metadata.items('bundle_budgets'):
+            if bundle not in report:
+                print >>sys.stderr, ('Warning: There is a budget for {}, but '
+                                     'no such bundle'.format(bundle))
+                continue
+            size = report[bundle]['compressed']
+            if size > parse_size(budget):
+                problems.append(
+                    '{} is {} bytes compressed, exceeding its budget of '
+                    '{}'.format(bundle, size, budget),
+                )
+
+    def get_option(option, default=None):
+        if metadata.has_option('bundle_report', option):
+            return metadata.get('bundle_report', option)
+        return default
+
+    baseline_path = get_option('baseline')
+    max_growth = get_option('maxGrowth')
+    if baseline_path and max_growth:
+        baseline_path = os.path.join(params['baseDir'], baseline_path)
+        try:
+            with open(baseline_path, 'rb') as file:
+                baseline = json.load(file)
+        except IOError:
+            baseline = {}
+
+        max_growth = float(max_growth) / 100
+        for bundle, entry in sorted(report.iteritems()):
+            previous = baseline.get(bundle)
+            if not previous or not previous['compressed']:
+                continue
+            growth = float(entry['compressed']) / previous['compressed'] - 1
+            if growth > max_growth:
+                problems.append(
+                    '{} grew by {:.0%} compared to the baseline ({})'.format(
+                        bundle, growth,
+                        describe_module_changes(entry, previous),
+                    ),
+                )
+
+    if not problems:
+        return
+    if get_option('action', 'error') == 'warn':
+        for problem in problems:
+            print >>sys.stderr, 'Warning: ' + problem
+    else:
+        problems.insert(0, 'Bundle size budget exceeded:')
+        raise Exception('\n'.join(problems))
+
+
+def get_bundle_report_file_name(package_file):
+    return os.path.splitext(package_file)[0] + '-bundles.json'
+
+
+def write_bundle_report(package_file, report):
+    """Write the bundle report into a JSON file next to the package.
+
+    It can be used as the baseline for future builds.
+    """
+    if not isinstance(package_file, basestring):
+        return
+
+    with open(get_bundle_report_file_name(package_file), 'wb') as file:
+        json.dump(report, file, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+
+
+def scan_modules(root, directories):
+    """Map the module names which can be resolved in `root` to their files.
+
+    Names which would resolve to something other than a JavaScript file,
+    e.g. a directory, are mapped to None. The modification time of every
+    scanned directory is added to `directories`.
+    """
+    # Lower numbers take precedence, like when webpack probes for a module.
+    candidates = {}
+
+    def add(name, priority, path):
+        if name not in candidates or priority < candidates[name][0]:
+            candidates[name] = (priority, path)
+
+    try:
+        directories[root] = os.stat(root).st_mtime
+    except OSError:
+        directories[root] = None
+        return {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        relpath = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        prefix = '' if relpath == '.' else relpath + '/'
+        directories[dirpath] = os.stat(dirpath).st_mtime
+
+        for dirname in dirnames:
+            add(prefix + dirname, 3, None)
+        for filename in filenames:
+            name = prefix + filename
+            if filename.endswith('.js'):
+                add(name, 0, os.path.join(dirpath, filename))
+                add(name[:-len('.js')], 1, os.path.join(dirpath, filename))
+            else:
+                add(name, 0, None)
+                if filename.endswith('.json'):
+                    add(name[:-len('.json')], 2, None)
+
+    return {name: path for name, (_, path) in candidates.iteritems()}
+
+
+def get_module_index(resolve_paths, cache=None):
+    """Return aliases resolving the modules in `resolve_paths` directly.
+
+    Rather than probing each of the resolve paths for every (non-relative)
+    module, webpack can look up the file in the returned aliases. This
+    includes the names using the legacy prefix syntax (see
+    webpack_runner.js). Names which can't be resolved to a JavaScript file
+    unambiguously are left to webpack.
+    """
+    if cache:
+        index = cache.get_module_index(resolve_paths)
+        if index is not None:
+            return index
+
+    modules = {}
+    directories = {}
+    for root in resolve_paths:
+        for name, path in scan_modules(root, directories).iteritems():
+            modules.setdefault(name, path)
+
+    # Legacy names, i.e. with an underscore instead of the first slash, take
+    # precedence, like with the plugin rewriting them in webpack_runner.js.
+    index = {name + '$': path for name, path in modules.iteritems() if path}
+    for name, path in modules.iteritems():
+        prefix, slash, rest = name.partition('/')
+        if slash and prefix != 'lib' and '_' not in prefix:
+            legacy_name = prefix + '_' + rest
+            if path:
+                index[legacy_name + '$'] = path
+            else:
+                index.pop(legacy_name + '$', None)
+
+    if cache:
+        cache.add_module_index(resolve_paths, directories, index)
+    return index
+
+
+def is_aliased(name, aliases):
+    for alias in aliases:
+        if alias.endswith('$'):
+            if name == alias[:-1]:
+                return True
+        elif name == alias or name.startswith(alias + '/'):
+            return True
+    return False
+
+
+def use_native_bundler(params):
+    """Return whether to create the bundles without webpack.
+
+    This is only supported for the development environment, and enabled
+    with the devenvBundler = native option. Since the native bundler can't
+    create a shared bundle, webpack is used if the sharedBundle option is
+    given as well.
+    """
+    metadata = params['metadata']
+    if not params['devenv']:
+        return False
+    if not metadata.has_option('general', 'devenvBundler'):
+        return False
+    if metadata.get('general', 'devenvBundler') != 'native':
+        return False
+    if get_shared_bundle(params):
+        print >>sys.stderr, ('Warning: The native bundler doesn\'t support '
+                             'sharedBundle, using webpack instead')
+        return False
+    return True
+
+
+def get_bundles(params):
+    """Return the file name and entry points of each bundle to create."""
+    result = []
+    for item in params['metadata'].items('bundles'):
+        name, value = item
+        base_item_path = os.path.dirname(item.source)
+
+        bundle_file = os.path.relpath(os.path.join(base_item_path, name),
+                                      params['baseDir'])
+        entry_files = [os.path.join(base_item_path, module_path)
+                       for module_path in value.split()]
+        result.append((bundle_file, entry_files))
+    return result
+
+
+def get_shared_bundle(params):
+    """Return the file name of the bundle shared by all other bundles.
+
+    Modules used by multiple bundles are moved into the shared bundle, which
+    is loaded before them. None is returned unless the metadata enables
+    this with the sharedBundle option.
+    """
+    metadata = params['metadata']
+    if not metadata.has_section('bundles'):
+        return None
+    if not metadata.has_option('general', 'sharedBundle'):
+        return None
+    return metadata.get('general', 'sharedBundle')
+
+
+def add_shared_bundle(params, scripts, base=''):
+    """Insert the shared bundle (if any) before the first bundle in `scripts`.
+
+    The paths in `scripts` are relative to the directory `base` in the
+    package.
+    """
+    shared_bundle = get_shared_bundle(params)
+    if not shared_bundle:
+        return scripts
+
+    bundles = {bundle_file for bundle_file, _ in get_bundles(params)}
+    for i, script in enumerate(scripts):
+        if posixpath.normpath(posixpath.join(base, script)) in bundles:
+            shared_script = posixpath.relpath(shared_bundle, base or '.')
+            return scripts[:i] + [shared_script] + scripts[i:]
+    return scripts
+
+
 def create_bundles(params, files, bundle_tests):
+    """Create the bundles and add them to `files`.
+
+    Return a map of the source maps which are not supposed to be included
+    in the package, but written separately with write_source_maps(), and
+    the bundle report (if enabled) to be written with write_bundle_report().
+    """
     base_extension_path = params['baseDir']
     info_templates = {
         'chrome': 'chromeInfo.js.tmpl',
@@ -159,7 +772,7 @@ def create_bundles(params, files, bundle_tests):
     aliases = {
         # To use our custom loader for the info module we must first set up an
         # alias to a file that exists.
-        'info$': os.path.join(os.path.dirname(__file__), 'info.js'),
+        'info$': bundler.INFO_MODULE,
         # Prevent builtin Node.js modules from being used instead of our own
         # when the names clash. Once relative paths are used this won't be
         # necessary.
@@ -191,21 +804,31 @@ def create_bundles(params, files, bundle_tests):
         'info_module': info_module,
         'resolve_paths': resolve_paths,
         'aliases': aliases,
+        'bundle_options': get_bundle_options(params),
+        'report': has_bundle_report(params),
     }
 
-    for item in params['metadata'].items('bundles'):
-        name, value = item
-        base_item_path = os.path.dirname(item.source)
+    # Aliases given explicitly take precedence over the module index.
+    module_index = get_module_index(resolve_paths, files.cache)
+    configuration['module_index'] = {
+        name: path for name, path in module_index.iteritems()
+        if not is_aliased(name[:-1], aliases)
+    }
 
-        bundle_file = os.path.relpath(os.path.join(base_item_path, name),
-                                      base_extension_path)
-        entry_files = [os.path.join(base_item_path, module_path)
-                       for module_path in value.split()]
+    for bundle_file, entry_files in get_bundles(params):
         configuration['bundles'].append({
             'bundle_name': bundle_file,
             'entry_points': entry_files,
         })
 
+    shared_bundle = get_shared_bundle(params)
+    if shared_bundle:
+        configuration['shared_bundle'] = {
+            'bundle_name': shared_bundle,
+            'bundles': [bundle['bundle_name']
+                        for bundle in configuration['bundles']],
+        }
+
     if bundle_tests:
         qunit_path = os.path.join(base_extension_path, 'qunit')
         qunit_files = ([os.path.join(qunit_path, 'common.js')] +
@@ -215,21 +838,63 @@ def create_bundles(params, files, bundle_tests):
             'entry_points': qunit_files,
         })
 
-    cmd = ['node', os.path.join(os.path.dirname(__file__), 'webpack_runner.js')]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stdin=subprocess.PIPE)
-    output = process.communicate(input=toJson(configuration))[0]
-    if process.returncode != 0:
-        raise subprocess.CalledProcessError(process.returncode, cmd=cmd)
-    output = json.loads(output)
+    # Unless any of the included modules changed, the bundles from a previous
+    # build are used, without running webpack at all. Otherwise, webpack
+    # still only builds the modules which changed, caching the others in the
+    # given directory.
+    cache = files.cache
+    key = cached = None
+    if use_native_bundler(params):
+        with profiler.stage('native bundler'):
+            outputs, included, modules = bundler.create_bundles(configuration)
+        cached = included, outputs, modules
+    elif cache:
+        configuration['cache_dir'] = cache.webpack_path
+        key = get_bundles_cache_key(configuration)
+        cached = get_cached_bundles(cache, key, base_extension_path)
+    if cached:
+        included, outputs, modules = cached
+    else:
+        included, outputs, modules = run_webpack(configuration, cache, key,
+                                                 params['webpackWorkers'])
 
     # Clear the mapping for any files included in a bundle, to avoid them being
     # duplicated in the build.
-    for to_ignore in output['included']:
+    for to_ignore in included:
         files.pop(to_ignore, None)
 
-    for bundle in output['files']:
-        files[bundle] = output['files'][bundle].encode('utf-8')
+    source_maps = {}
+    if configuration['bundle_options']['source_maps'] == 'separate':
+        for name in list(outputs):
+            if name.endswith('.map'):
+                source_maps[name] = outputs.pop(name)
+
+    for bundle in outputs:
+        files[bundle] = outputs[bundle]
+
+    report = None
+    if configuration['report']:
+        report = create_bundle_report(files, modules)
+        if configuration['bundle_options']['minify']:
+            check_bundle_report(params, report)
+    return source_maps, report
+
+
+def read_locale_source(path):
+    # Parsed locale files are shared by all builds in this process, so that
+    # they are only read once when building for multiple platforms. Only the
+    # latest contents are kept for every file, so that the cache doesn't
+    # grow when watching the sources.
+    stat = os.stat(path)
+    entry = read_locale_source.sources.get(path)
+    if not entry or entry[:2] != (stat.st_size, stat.st_mtime):
+        with io.open(path, 'r', encoding='utf-8') as handle:
+            entry = (stat.st_size, stat.st_mtime, json.load(handle))
+        read_locale_source.sources[path] = entry
+    return entry[2]
+
+
+read_locale_source.sources = {}
 
 
 def import_locales(params, files):
@@ -243,8 +908,7 @@ def import_locales(params, files):
             data = json.loads(files.get(targetFile, '{}').decode('utf-8'))
 
             try:
-                with io.open(sourceFile, 'r', encoding='utf-8') as handle:
-                    sourceData = json.load(handle)
+                sourceData = read_locale_source(sourceFile)
 
                 # Resolve wildcard imports
                 if keys == '*':
@@ -311,22 +975,13 @@ def fix_translations_for_chrome(files):
                 files['_locales/es_419/' + filename] = data
 
 
+# signBinary(), getPublicKey() and writePackage() are kept for external
+# callers, but build the package in memory. Use write_package() instead.
 def signBinary(zipdata, keyFile):
     from Crypto.Hash import SHA
-    from Crypto.PublicKey import RSA
     from Crypto.Signature import PKCS1_v1_5
 
-    try:
-        with open(keyFile, 'rb') as file:
-            key = RSA.importKey(file.read())
-    except IOError as e:
-        if e.errno != errno.ENOENT:
-            raise
-        key = RSA.generate(2048)
-        with open(keyFile, 'wb') as file:
-            file.write(key.exportKey('PEM'))
-
-    return PKCS1_v1_5.new(key).sign(SHA.new(zipdata))
+    return PKCS1_v1_5.new(get_signing_key(keyFile)).sign(SHA.new(zipdata))
 
 
 def getPublicKey(keyFile):
@@ -347,26 +1002,144 @@ def writePackage(outputFile, pubkey, signature, zipdata):
     file.write(zipdata)
 
 
+def get_signing_key(keyFile):
+    from Crypto.PublicKey import RSA
+
+    try:
+        with open(keyFile, 'rb') as file:
+            return RSA.importKey(file.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        key = RSA.generate(2048)
+        with open(keyFile, 'wb') as file:
+            file.write(key.exportKey('PEM'))
+        return key
+
+
+class HashingWriter(object):
+    """File-like object passing data through to a file while hashing it.
+
+    Positions reported by tell() are relative to where the file was when
+    the writer was created, so that a zip archive written through it stays
+    valid when prefixed with a header.
+    """
+
+    def __init__(self, file, digest):
+        self._file = file
+        self._start = file.tell()
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        self._file.write(data)
+
+    def tell(self):
+        return self._file.tell() - self._start
+
+    def flush(self):
+        self._file.flush()
+
+
+def write_package(outputFile, files, keyFile=None):
+    """Write the zip archive for `files`, as a signed CRX if keyFile is given.
+
+    The archive is compressed straight into the output file. Space for the
+    CRX header is reserved up front, and the signature is filled in after
+    the archive has been written, from the digest calculated on the fly.
+    If a file name is given, the package is written to a temporary file
+    first, so that no incomplete package is left behind if the build fails.
+    """
+    if not isinstance(outputFile, basestring):
+        write_archive(outputFile, files, keyFile)
+        return
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(outputFile)),
+        suffix=FileCache.TEMP_SUFFIX,
+    )
+    os.close(fd)
+    try:
+        # The file is created anew, with the default permissions.
+        with open(temp_path, 'wb') as file:
+            write_archive(file, files, keyFile)
+        _replace_file(temp_path, outputFile)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_archive(file, files, keyFile=None):
+    if keyFile is None:
+        files.zip(file)
+    else:
+        write_signed_package(file, files, keyFile)
+
+
+def write_signed_package(file, files, keyFile):
+    from Crypto.Hash import SHA
+    from Crypto.Signature import PKCS1_v1_5
+
+    key = get_signing_key(keyFile)
+    pubkey = key.publickey().exportKey('DER')
+    signature_size = (key.n.bit_length() + 7) // 8
+
+    file.write(struct.pack('<4sIII', 'Cr24', 2, len(pubkey), signature_size))
+    file.write(pubkey)
+    signature_offset = file.tell()
+    file.write('\0' * signature_size)
+
+    writer = HashingWriter(file, SHA.new())
+    files.zip(writer)
+
+    with profiler.stage('sign package'):
+        signature = PKCS1_v1_5.new(key).sign(writer.digest)
+    assert len(signature) == signature_size
+    end_offset = file.tell()
+    file.seek(signature_offset)
+    file.write(signature)
+    file.seek(end_offset)
+
+
 def add_devenv_requirements(files, metadata, params):
+    """Add the files needed by the devenv, and return its version."""
     files.read(
         os.path.join(os.path.dirname(__file__), 'chromeDevenvPoller__.js'),
         relpath='devenvPoller__.js',
     )
-    files['devenvVersion__'] = str(random.random())
+    # The server notifies the devenv about rebuilds (see reloadserver.py) if
+    # it's running, otherwise devenvPoller__.js polls for changes.
+    if params['devenvServer']:
+        files['devenvServer__'] = params['devenvServer']
 
     if metadata.has_option('general', 'testScripts'):
         files['qunit/index.html'] = createScriptPage(
             params, 'testIndex.html.tmpl', ('general', 'testScripts'),
+            'qunit',
         )
 
+    # The version is derived from the contents of all files, so that the
+    # extension is only reloaded if a rebuild actually changed anything.
+    # The digests of the individual files are listed as well, so that it
+    # can be determined which files changed.
+    files['devenvFiles__'] = toJson({name: files.get_digest(name)
+                                     for name in files})
+    files['devenvVersion__'] = hashlib.sha1(
+        files['devenvFiles__'],
+    ).hexdigest()
+    return files['devenvVersion__']
 
-def createBuild(baseDir, type='chrome', outFile=None, buildNum=None, releaseBuild=False, keyFile=None, devenv=False):
+
+def createBuild(baseDir, type='chrome', outFile=None, buildNum=None, releaseBuild=False, keyFile=None, devenv=False, cache=None, webpackWorkers=None, devenvServer=None):
     metadata = readMetadata(baseDir, type)
     version = getBuildVersion(baseDir, metadata, releaseBuild, buildNum)
 
     if outFile == None:
-        file_extension = get_extension(type, keyFile is not None)
-        outFile = getDefaultFileName(metadata, version, file_extension)
+        if devenv:
+            outFile = getDevEnvPath(baseDir, type)
+        else:
+            file_extension = get_extension(type, keyFile is not None)
+            outFile = getDefaultFileName(metadata, version, file_extension)
 
     params = {
         'type': type,
@@ -375,39 +1148,71 @@ def createBuild(baseDir, type='chrome', outFile=None, buildNum=None, releaseBuil
         'version': version,
         'devenv': devenv,
         'metadata': metadata,
+        'webpackWorkers': webpackWorkers,
+        'devenvServer': devenvServer,
     }
 
+    # The processed file contents are reused from previous builds, so any
+    # parameter which could affect processFile() has to be part of the salt.
+    # If a cache is given, it's shared with other builds and saved by the
+    # caller.
+    salt = json.dumps([type, version, releaseBuild, devenv])
+    if cache:
+        own_cache = None
+        cache = cache.salted(salt)
+    else:
+        own_cache = cache = FileCache(get_cache_path(baseDir), salt=salt)
+
     mapped = metadata.items('mapping') if metadata.has_section('mapping') else []
     files = Files(getPackageFiles(params), getIgnoredFiles(params),
-                  process=lambda path, data: processFile(path, data, params))
+                  process=lambda path, data: processFile(path, data, params),
+                  cache=cache)
 
-    files.readMappedFiles(mapped)
-    files.read(baseDir, skip=[opt for opt, _ in mapped])
+    with profiler.stage('read mapped files'):
+        files.readMappedFiles(mapped)
+    with profiler.stage('read files'):
+        files.read(baseDir, skip=[opt for opt, _ in mapped])
 
+    source_maps = report = None
     if metadata.has_section('bundles'):
         bundle_tests = devenv and metadata.has_option('general', 'testScripts')
-        create_bundles(params, files, bundle_tests)
+        with profiler.stage('create bundles'):
+            source_maps, report = create_bundles(params, files, bundle_tests)
 
     if metadata.has_section('preprocess'):
-        files.preprocess(
-            [f for f, _ in metadata.items('preprocess')],
-            {'needsExt': True},
-        )
+        with profiler.stage('preprocess'):
+            files.preprocess(
+                [f for f, _ in metadata.items('preprocess')],
+                {'needsExt': True},
+            )
 
     if metadata.has_section('import_locales'):
-        import_locales(params, files)
+        with profiler.stage('import locales'):
+            import_locales(params, files)
 
-    files['manifest.json'] = createManifest(params, files)
+    with profiler.stage('create manifest'):
+        files['manifest.json'] = createManifest(params, files)
     if type == 'chrome':
-        fix_translations_for_chrome(files)
+        with profiler.stage('fix translations'):
+            fix_translations_for_chrome(files)
 
+    devenv_version = None
     if devenv:
-        add_devenv_requirements(files, metadata, params)
-
-    zipdata = files.zipToString()
-    signature = None
-    pubkey = None
-    if keyFile != None:
-        signature = signBinary(zipdata, keyFile)
-        pubkey = getPublicKey(keyFile)
-    writePackage(outFile, pubkey, signature, zipdata)
+        devenv_version = add_devenv_requirements(files, metadata, params)
+        with profiler.stage('write devenv'):
+            files.write_directory(outFile)
+    else:
+        with profiler.stage('write package', signed=keyFile is not None):
+            write_package(outFile, files, keyFile)
+    if source_maps:
+        with profiler.stage('write source maps'):
+            write_source_maps(outFile, source_maps)
+    if report and not devenv:
+        write_bundle_report(outFile, report)
+
+    if own_cache:
+        with profiler.stage('save cache'):
+            own_cache.save()
+
+    # "build.py devenv --watch" notifies the devenv about the new version.
+    return devenv_version
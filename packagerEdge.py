@@ -11,6 +11,7 @@ import zipfile
 
 import packager
 import packagerChrome
+import profiler
 
 # Files and directories expected inside of the .APPX archive.
 MANIFEST = 'AppxManifest.xml'
@@ -60,7 +61,7 @@ def create_appx_blockmap(files):
     # uncompressed zip file that is later repackaged by Windows Store with
     # compression.
     template = _get_template_for(BLOCKMAP)
-    files = [_make_blockmap_entry(n, d) for n, d in files.items()]
+    files = [_make_blockmap_entry(n, d) for n, d in files.iteritems()]
     return template.render(files=files).encode('utf-8')
 
 
@@ -149,13 +150,18 @@ def create_content_types_map(filenames):
 
 def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
                 buildNum=None, releaseBuild=False, keyFile=None,
-                devenv=False):
+                devenv=False, cache=None, webpackWorkers=None,
+                devenvServer=None):
 
     metadata = packager.readMetadata(baseDir, type)
     version = packager.getBuildVersion(baseDir, metadata, releaseBuild,
                                        buildNum)
 
-    outfile = outFile or packager.getDefaultFileName(metadata, version, 'appx')
+    if devenv:
+        outfile = outFile or packager.getDevEnvPath(baseDir, type)
+    else:
+        outfile = outFile or packager.getDefaultFileName(metadata, version,
+                                                         'appx')
 
     params = {
         'type': type,
@@ -164,32 +170,56 @@ def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
         'version': version,
         'devenv': devenv,
         'metadata': metadata,
+        'webpackWorkers': webpackWorkers,
+        'devenvServer': devenvServer,
     }
 
+    # If a cache is given, it's shared with other builds and saved by the
+    # caller.
+    own_cache = None
+    if not cache:
+        own_cache = cache = packager.FileCache(
+            packager.get_cache_path(baseDir),
+        )
     files = packager.Files(packagerChrome.getPackageFiles(params),
-                           packagerChrome.getIgnoredFiles(params))
+                           packagerChrome.getIgnoredFiles(params),
+                           cache=cache)
 
     if metadata.has_section('mapping'):
         mapped = metadata.items('mapping')
-        files.readMappedFiles(mapped)
-        files.read(baseDir, skip=[filename for filename, _ in mapped])
+        with profiler.stage('read mapped files'):
+            files.readMappedFiles(mapped)
+        with profiler.stage('read files'):
+            files.read(baseDir, skip=[filename for filename, _ in mapped])
     else:
-        files.read(baseDir)
+        with profiler.stage('read files'):
+            files.read(baseDir)
 
+    source_maps = report = None
     if metadata.has_section('bundles'):
         bundle_tests = devenv and metadata.has_option('general', 'testScripts')
-        packagerChrome.create_bundles(params, files, bundle_tests)
+        with profiler.stage('create bundles'):
+            source_maps, report = packagerChrome.create_bundles(
+                params, files, bundle_tests,
+            )
 
     if metadata.has_section('preprocess'):
-        files.preprocess(metadata.options('preprocess'), {'needsExt': True})
+        with profiler.stage('preprocess'):
+            files.preprocess(metadata.options('preprocess'),
+                             {'needsExt': True})
 
     if metadata.has_section('import_locales'):
-        packagerChrome.import_locales(params, files)
+        with profiler.stage('import locales'):
+            packagerChrome.import_locales(params, files)
 
-    files['manifest.json'] = packagerChrome.createManifest(params, files)
+    with profiler.stage('create manifest'):
+        files['manifest.json'] = packagerChrome.createManifest(params, files)
 
+    devenv_version = None
     if devenv:
-        packagerChrome.add_devenv_requirements(files, metadata, params)
+        devenv_version = packagerChrome.add_devenv_requirements(
+            files, metadata, params,
+        )
 
     move_files_to_extension(files)
 
@@ -198,9 +228,28 @@ def createBuild(baseDir, type='edge', outFile=None,  # noqa: preserve API.
             path = os.path.join(baseDir, path)
             files.read(path, '{}/{}'.format(ASSETS_DIR, name))
 
-    files[MANIFEST] = create_appx_manifest(params, files,
-                                           buildNum, releaseBuild)
-    files[BLOCKMAP] = create_appx_blockmap(files)
-    files[CONTENT_TYPES] = create_content_types_map(files.keys() + [BLOCKMAP])
+    with profiler.stage('create APPX files'):
+        files[MANIFEST] = create_appx_manifest(params, files,
+                                               buildNum, releaseBuild)
+        files[BLOCKMAP] = create_appx_blockmap(files)
+        files[CONTENT_TYPES] = create_content_types_map(
+            files.keys() + [BLOCKMAP],
+        )
 
-    files.zip(outfile, compression=zipfile.ZIP_STORED)
+    if devenv:
+        with profiler.stage('write devenv'):
+            files.write_directory(outfile)
+    else:
+        with profiler.stage('write package'):
+            files.zip(outfile, compression=zipfile.ZIP_STORED)
+    if source_maps:
+        with profiler.stage('write source maps'):
+            packagerChrome.write_source_maps(outfile, source_maps)
+    if report and not devenv:
+        packagerChrome.write_bundle_report(outfile, report)
+
+    if own_cache:
+        with profiler.stage('save cache'):
+            own_cache.save()
+
+    return devenv_version
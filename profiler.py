@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Record the wall time, CPU time and peak memory of build stages.
+
+Profiling is disabled unless start() is called, in which case every
+stage() is recorded. The results can be written as a trace in the Chrome
+trace event format (to be loaded in chrome://tracing), and summarized.
+
+CPU time and memory usage are only known on platforms providing the
+resource module, i.e. not on Windows, where only the CPU time of this
+process is recorded. Since only the peak memory usage of the process so far
+is known, stages are summarized with how much they raised it.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_events = None
+_start_time = None
+
+
+def start():
+    global _events, _start_time
+    _events = []
+    _start_time = time.time()
+
+
+def is_active():
+    return _events is not None
+
+
+def _get_cpu_time():
+    if not resource:
+        user_time, system_time = os.times()[:2]
+        return user_time + system_time
+
+    # Child processes are only included once they have been waited for, so
+    # the CPU time of the persistent webpack workers isn't accounted for.
+    cpu_time = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu_time += usage.ru_utime + usage.ru_stime
+    return cpu_time
+
+
+def _get_peak_memory():
+    """Return the peak resident set size of this and child processes in KiB.
+
+    Note that the peak of child processes is the one of the largest child
+    which has been waited for. None is returned if it's unknown.
+    """
+    if not resource:
+        return [None, None]
+
+    result = []
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        peak = resource.getrusage(who).ru_maxrss
+        if sys.platform == 'darwin':
+            peak //= 1024
+        result.append(peak)
+    return result
+
+
+@contextmanager
+def stage(name, **args):
+    """Record the stage `name` for the duration of the with-statement.
+
+    Additional keyword arguments are included with the recorded event.
+    """
+    if _events is None:
+        yield
+        return
+
+    start_time = time.time()
+    start_cpu_time = _get_cpu_time()
+    start_peak_memory = _get_peak_memory()[0]
+    try:
+        yield
+    finally:
+        peak_memory, peak_child_memory = _get_peak_memory()
+        peak_memory_growth = None
+        if peak_memory is not None:
+            peak_memory_growth = max(0, peak_memory - start_peak_memory)
+        event_args = dict(args)
+        event_args.update({
+            'cpu_ms': int((_get_cpu_time() - start_cpu_time) * 1000),
+            'peak_memory_kib': peak_memory,
+            'peak_memory_growth_kib': peak_memory_growth,
+            'peak_child_memory_kib': peak_child_memory,
+        })
+        _events.append({
+            'name': name,
+            'cat': 'build',
+            'ph': 'X',
+            'ts': int((start_time - _start_time) * 1000000),
+            'dur': int((time.time() - start_time) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': event_args,
+        })
+
+
+def write_trace(path):
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, file,
+                  indent=1, sort_keys=True)
+
+
+def format_summary():
+    lines = ['{:<40} {:>10} {:>10} {:>12}'.format(
+        'Stage', 'Wall (ms)', 'CPU (ms)', 'Peak+ (MiB)',
+    )]
+    # Nested stages are indented below the stage they are part of.
+    events = sorted(_events, key=lambda event: (event['ts'], -event['dur']))
+    open_events = []
+    for event in events:
+        end = event['ts'] + event['dur']
+        open_events = [other for other in open_events
+                       if other['ts'] + other['dur'] >= end]
+        name = '  ' * len(open_events) + event['name']
+        open_events.append(event)
+
+        growth = event['args']['peak_memory_growth_kib']
+        lines.append('{:<40} {:>10} {:>10} {:>12}'.format(
+            name[:40],
+            event['dur'] // 1000,
+            event['args']['cpu_ms'],
+            'n/a' if growth is None else '{:.1f}'.format(growth / 1024.0),
+        ))
+    lines.append('Peak+ is how much a stage raised the peak memory usage of '
+                 'the process so far.')
+    lines.append('CPU time and peak memory exclude the webpack workers.')
+    return '\n'.join(lines)
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Notify development environments about rebuilds, for `devenv --watch`.
+
+devenvPoller__.js requests the server's URL with the devenvVersion__ it was
+loaded with. The response is delayed until the version differs, i.e. the
+devenv has been rebuilt, or the request times out (long polling).
+"""
+
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        known_version = query.get('version', [None])[0]
+        version = self.server.wait_for_version(known_version)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Cache-Control', 'no-cache')
+        # Requests are made from the extension's origin.
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(version)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReloadServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # Seconds after which requests are answered with the current version,
+    # even if it didn't change, so that they don't run into timeouts.
+    WAIT_TIMEOUT = 30
+
+    def __init__(self, port=0):
+        # Only accept connections from the local machine.
+        HTTPServer.__init__(self, ('127.0.0.1', port), RequestHandler)
+        self._version = None
+        self._condition = threading.Condition()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def set_version(self, version):
+        with self._condition:
+            self._version = version
+            self._condition.notify_all()
+
+    def wait_for_version(self, known_version, timeout=None):
+        """Return the current version once it differs from `known_version`.
+
+        If it doesn't change within `timeout` seconds (WAIT_TIMEOUT by
+        default), the current version is returned nevertheless.
+        """
+        deadline = time.time() + (timeout or self.WAIT_TIMEOUT)
+        with self._condition:
+            # Until the first build finished, the version isn't known yet.
+            while self._version in {None, known_version}:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._version or known_version or ''
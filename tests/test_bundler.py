@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import subprocess
+
+import pytest
+
+from buildtools import bundler
+
+
+@pytest.fixture
+def srcdir(tmpdir):
+    files = {
+        'ext/a.js': ('// require("commented");\n'
+                     'log(require("./c.js"));\n'
+                     'log(require("info").addonVersion);\n'
+                     'log(require("mogo"));\n'
+                     'log(require("sub_d"));'),
+        'ext/c.js': 'module.exports = "c";',
+        'lib/edge.js': 'module.exports = "edge";',
+        'lib/sub/d.js': 'module.exports = require("../data.json").d;',
+        'lib/data.json': '{"d": "d"}',
+        'lib/b.js': 'log("b");',
+    }
+    for name, content in files.items():
+        tmpdir.join(*name.split('/')).write(content, ensure=True)
+    return tmpdir
+
+
+def create_bundles(srcdir):
+    return bundler.create_bundles({
+        'bundles': [{
+            'bundle_name': 'lib/foo.js',
+            'entry_points': [str(srcdir.join('ext', 'a.js')),
+                             str(srcdir.join('lib', 'b.js'))],
+        }],
+        'extension_path': str(srcdir),
+        'info_module': 'exports.addonVersion = "1.2.3";',
+        'resolve_paths': [str(srcdir.join('lib'))],
+        'aliases': {'info$': bundler.INFO_MODULE, 'mogo': 'edge'},
+    })
+
+
+def test_create_bundles(srcdir):
+    files, included, modules = create_bundles(srcdir)
+
+    assert sorted(included) == sorted([
+        'ext/a.js', 'ext/c.js', 'lib/b.js', 'lib/edge.js', 'lib/sub/d.js',
+        'lib/data.json', os.path.relpath(bundler.INFO_MODULE, str(srcdir)),
+    ])
+    assert sorted(modules['lib/foo.js']) == sorted(included)
+
+    source_map = json.loads(files['lib/foo.js.map'])
+    assert 'webpack:///./ext/a.js' in source_map['sources']
+    assert files['lib/foo.js'].endswith('//# sourceMappingURL=foo.js.map\n')
+
+    script = 'var log = console.log;\n' + files['lib/foo.js']
+    output = subprocess.check_output(['node', '-e', script])
+    assert output.splitlines() == ['c', '1.2.3', 'edge', 'd', 'b']
+
+
+def test_create_bundles_missing_module(srcdir):
+    srcdir.join('lib', 'b.js').write('require("missing");')
+    with pytest.raises(bundler.BundleError):
+        create_bundles(srcdir)
+
+
+def test_source_map_mappings():
+    assert bundler.encode_vlq(0) == 'A'
+    assert bundler.encode_vlq(1) == 'C'
+    assert bundler.encode_vlq(-1) == 'D'
+    assert bundler.encode_vlq(16) == 'gB'
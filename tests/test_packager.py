@@ -0,0 +1,419 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import hashlib
+import os
+import time
+import zipfile
+from StringIO import StringIO
+
+import pytest
+
+from buildtools import packager
+
+
+@pytest.fixture
+def srcdir(tmpdir):
+    """Source directory with files old enough to be cached."""
+    mtime = time.time() - 60
+    for name in ['lib/foo.js', 'lib/bar.js', 'ui/index.html']:
+        path = tmpdir.join(*name.split('/'))
+        path.write('content of ' + name, ensure=True)
+        path.setmtime(mtime)
+    return tmpdir
+
+
+def read_files(srcdir, cache, calls):
+    def process(path, data):
+        calls.append(path)
+        return data.upper() if path.endswith('.js') else data
+
+    files = packager.Files({'lib', 'ui'}, set(), process=process, cache=cache)
+    files.read(str(srcdir))
+    return files
+
+
+def test_cache_reuses_processed_files(srcdir, tmpdir):
+    cache_path = str(tmpdir.join('cache'))
+    calls = []
+
+    cache = packager.FileCache(cache_path, salt='chrome')
+    first = read_files(srcdir, cache, calls)
+    cache.save()
+    assert sorted(calls) == ['lib/bar.js', 'lib/foo.js', 'ui/index.html']
+
+    del calls[:]
+    cache = packager.FileCache(cache_path, salt='chrome')
+    second = read_files(srcdir, cache, calls)
+    assert calls == []
+    assert sorted(second.items()) == sorted(first.items())
+    assert second['lib/foo.js'] == 'CONTENT OF LIB/FOO.JS'
+
+    # A different salt must not reuse the processed contents.
+    cache = packager.FileCache(cache_path, salt='gecko')
+    read_files(srcdir, cache, calls)
+    assert sorted(calls) == ['lib/bar.js', 'lib/foo.js', 'ui/index.html']
+
+
+def test_cache_detects_changes(srcdir, tmpdir):
+    cache_path = str(tmpdir.join('cache'))
+    cache = packager.FileCache(cache_path)
+    read_files(srcdir, cache, [])
+    cache.save()
+
+    path = srcdir.join('lib', 'foo.js')
+    path.write('changed')
+    path.setmtime(time.time() - 30)
+
+    calls = []
+    cache = packager.FileCache(cache_path)
+    files = read_files(srcdir, cache, calls)
+    assert calls == ['lib/foo.js']
+    assert files['lib/foo.js'] == 'CHANGED'
+
+    # Only the latest processed contents are kept around, once other builds
+    # can't be using the previous ones anymore.
+    objects = tmpdir.join('cache', 'objects')
+    mtime = time.time() - cache.IN_USE_MAX_AGE - 60
+    for path in objects.listdir():
+        path.setmtime(mtime)
+    cache.save()
+    assert len(objects.listdir()) == 2
+
+
+def test_cache_shared_by_multiple_builds(srcdir, tmpdir):
+    cache_path = str(tmpdir.join('cache'))
+    first = packager.FileCache(cache_path)
+    second = packager.FileCache(cache_path)
+
+    bundle = tmpdir.join('cache', 'output', 'bundle.js')
+    bundle.write('var bundle;', ensure=True)
+    outputs = second.add_bundles('key', {}, {'bundle.js': str(bundle)})
+    read_files(srcdir, first, [])
+
+    # Saving the first cache must neither remove the bundles of the second,
+    # nor drop them from the index.
+    first.save()
+    assert outputs['bundle.js'].read() == 'var bundle;'
+    second.save()
+
+    calls = []
+    cache = packager.FileCache(cache_path)
+    read_files(srcdir, cache, calls)
+    assert calls == []
+    included, outputs, modules = cache.get_bundles('key')
+    assert outputs['bundle.js'].read() == 'var bundle;'
+
+
+def test_cache_removes_unused_webpack_caches(tmpdir):
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+    unused = tmpdir.join('cache', 'webpack', 'unused', 'hard-source', 'x')
+    unused.write('', ensure=True)
+    tmpdir.join('cache', 'webpack', 'unused').setmtime(
+        time.time() - cache.UNUSED_MAX_AGE - 60,
+    )
+    tmpdir.join('cache', 'webpack', 'used', 'uglify', 'x').write(
+        '', ensure=True,
+    )
+    cache.save()
+    assert os.listdir(cache.webpack_path) == ['used']
+
+
+def test_read_respects_include_and_ignore(srcdir, capsys):
+    srcdir.join('lib', 'nested', 'deep', 'baz.js').write('baz', ensure=True)
+    srcdir.join('lib', 'nested', 'ignored', 'x.js').write('x', ensure=True)
+    srcdir.join('other', 'y.js').write('y', ensure=True)
+
+    files = packager.Files({'lib', 'ui'}, {'ignored'})
+    files.read(str(srcdir), skip=['ui/index.html'])
+    assert sorted(files) == [
+        'lib/bar.js', 'lib/foo.js', 'lib/nested/deep/baz.js',
+    ]
+
+    files.read(str(srcdir.join('lib')), 'lib')
+    out, err = capsys.readouterr()
+    assert 'File lib/foo.js defined multiple times' in err
+
+
+def test_files_are_loaded_lazily(srcdir):
+    files = packager.Files({'lib', 'ui'}, set())
+    files.read(str(srcdir))
+    assert isinstance(files.pop('lib/bar.js'), packager.LazyFile)
+
+    srcdir.join('lib', 'foo.js').write('modified')
+    assert files['lib/foo.js'] == 'modified'
+    assert files.get('lib/foo.js') == 'modified'
+    assert dict(files.items())['lib/foo.js'] == 'modified'
+    assert files.get('lib/bar.js', 'missing') == 'missing'
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_DEFLATED,
+                                         zipfile.ZIP_STORED])
+def test_zip_is_independent_of_thread_count(srcdir, compression):
+    files = packager.Files({'lib', 'ui'}, set())
+    files.read(str(srcdir))
+    files['lib/generated.js'] = os.urandom(200000)
+
+    archives = []
+    for threads in [1, 3]:
+        output = StringIO()
+        files.zip(output, compression=compression, threads=threads)
+        archives.append(output.getvalue())
+    assert archives[0] == archives[1]
+
+    with zipfile.ZipFile(StringIO(archives[0])) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read('lib/foo.js') == 'content of lib/foo.js'
+        assert zip_file.read('lib/generated.js') == files['lib/generated.js']
+
+
+def test_zip_reuses_compressed_data(srcdir, tmpdir, monkeypatch):
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1500000000')
+    cache_path = str(tmpdir.join('cache'))
+
+    def build_archive():
+        cache = packager.FileCache(cache_path)
+        files = packager.Files({'lib', 'ui'}, set(), cache=cache)
+        files.read(str(srcdir))
+        files['generated.js'] = 'var generated;'
+        output = StringIO()
+        files.zip(output, threads=1)
+        cache.save()
+        return output.getvalue()
+
+    first = build_archive()
+
+    def compress_uncached(value, compression):
+        raise AssertionError('Compressed data should have been cached')
+
+    monkeypatch.setattr(packager, '_compress_uncached', compress_uncached)
+    assert build_archive() == first
+
+    with zipfile.ZipFile(StringIO(first)) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.getinfo('generated.js').date_time[0] == 2017
+
+
+@pytest.mark.parametrize('pattern,path,expected', [
+    ('store.description', 'store.description', True),
+    ('store.description', 'lib/store.description', True),
+    ('store.description', 'lib/store.descriptions', False),
+    ('node_modules', 'lib/node_modules/foo/index.js', True),
+    ('lib/node_modules', 'lib/node_modules/foo/index.js', True),
+    ('lib/node_modules', 'ui/lib/node_modules/foo.js', False),
+    ('*.md', 'lib/README.md', True),
+    ('lib/*.md', 'lib/docs/README.md', False),
+    ('lib/**/*.md', 'lib/docs/README.md', True),
+    ('lib/**/*.md', 'lib/README.md', True),
+    ('lib/**', 'lib/foo.js', True),
+    ('ui/?.js', 'ui/a.js', True),
+    ('ui/?.js', 'ui/ab.js', False),
+])
+def test_compile_patterns(pattern, path, expected):
+    regex = packager.compile_patterns([pattern])
+    assert (regex.search(path) is not None) == expected
+
+
+@pytest.fixture(params=['scandir', 'listdir'])
+def list_directory(request, monkeypatch):
+    if request.param == 'scandir':
+        if not packager.scandir:
+            pytest.skip('scandir is not available')
+    else:
+        monkeypatch.setattr(packager, 'scandir', None)
+
+
+def test_list_directory(tmpdir, list_directory):
+    tmpdir.join('dir', 'file').write('', ensure=True)
+    tmpdir.join('file').write('')
+    assert sorted(packager._list_directory(str(tmpdir))) == [
+        ('dir', True), ('file', False),
+    ]
+
+
+def test_read_prunes_excluded_directories(srcdir, monkeypatch,
+                                          list_directory):
+    srcdir.join('lib', 'node_modules', 'dep.js').write('', ensure=True)
+    srcdir.join('lib', 'docs', 'README.md').write('', ensure=True)
+
+    listed = []
+    list_directory = packager._list_directory
+
+    def record(path):
+        listed.append(os.path.relpath(path, str(srcdir)))
+        return list_directory(path)
+
+    monkeypatch.setattr(packager, '_list_directory', record)
+    files = packager.Files({'lib', 'ui'}, {'lib/node_modules', '*.md'})
+    files.read(str(srcdir))
+
+    assert sorted(files) == ['lib/bar.js', 'lib/foo.js', 'ui/index.html']
+    assert sorted(listed) == ['.', 'lib', 'lib/docs', 'ui']
+
+
+def test_preprocess_reuses_compiled_templates():
+    files = packager.Files(set(), set())
+    files['a.html'] = '<p>{{ text }}</p>'
+    files['b.js'] = 'var text = "{{ text }}";'
+    files['c.html'] = '<p>{{ text }}</p>'
+    files.preprocess(['a.html', 'b.js', 'c.html'], {'text': '<b>'})
+
+    assert files['a.html'] == files['c.html'] == '<p>&lt;b&gt;</p>'
+    assert files['b.js'] == 'var text = "<b>";'
+
+    source = u'<p>{{ text }}</p>'
+    assert (packager.get_string_template(source, 'a.html', True) is
+            packager.get_string_template(source, 'c.html', True))
+    # Only the compiled templates are kept.
+    assert packager._string_templates == {}
+
+
+def test_salted_caches_share_digests(srcdir, tmpdir):
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+    srcdir.join('lib', 'foo.js').write('just modified')
+
+    calls = []
+    read_files(srcdir, cache.salted('chrome'), calls)
+    files = read_files(srcdir, cache.salted('gecko'), calls)
+    assert sorted(calls) == ['lib/bar.js', 'lib/bar.js', 'lib/foo.js',
+                             'lib/foo.js', 'ui/index.html', 'ui/index.html']
+
+    assert files['lib/foo.js'] == 'JUST MODIFIED'
+
+    # Recently modified files are recognized within the same process only.
+    path = str(srcdir.join('lib', 'foo.js'))
+    assert cache.get_digest(path, os.stat(path)) is not None
+    cache.save()
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+    assert cache.get_digest(path, os.stat(path)) is None
+
+
+def test_write_directory_only_writes_changes(srcdir, tmpdir):
+    output = tmpdir.join('devenv')
+    output.join('stale', 'old.js').write('old', ensure=True)
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+
+    files = packager.Files({'lib', 'ui'}, set(), cache=cache)
+    files.read(str(srcdir))
+    files['generated.js'] = 'var generated;'
+    written = files.write_directory(str(output))
+    assert written == ['generated.js', 'lib/bar.js', 'lib/foo.js',
+                       'ui/index.html']
+    assert not output.join('stale').check()
+    assert output.join('lib', 'foo.js').read() == 'content of lib/foo.js'
+
+    del files['ui/index.html']
+    files['generated.js'] = 'var changed;'
+    # Files might be hardlinked to the sources, so replace rather than
+    # modify it.
+    output.join('lib', 'bar.js').remove()
+    output.join('lib', 'bar.js').write('modified in the devenv')
+    assert files.write_directory(str(output)) == ['generated.js',
+                                                  'lib/bar.js']
+    assert output.join('generated.js').read() == 'var changed;'
+    assert output.join('lib', 'bar.js').read() == 'content of lib/bar.js'
+    assert not output.join('ui').check()
+
+    # Temporary files must not clash with files in the map.
+    files['generated.js.tmp'] = 'var temporary;'
+    assert files.write_directory(str(output)) == ['generated.js.tmp']
+    files['generated.js'] = 'var generated;'
+    assert files.write_directory(str(output)) == ['generated.js']
+    assert output.join('generated.js').read() == 'var generated;'
+    assert output.join('generated.js.tmp').read() == 'var temporary;'
+    assert sorted(os.listdir(str(output))) == ['generated.js',
+                                               'generated.js.tmp', 'lib']
+
+
+def test_get_devenv_sources(tmpdir):
+    tmpdir.join('base', 'metadata.chrome').write(
+        '[default]\ninherit = ../dependency/metadata.common\n'
+        '[mapping]\nlib/mapped.js = ../dependency/lib/mapped.js\n',
+        ensure=True,
+    )
+    tmpdir.join('dependency', 'metadata.common').write(
+        '[general]\nbasename = test\n'
+        '[import_locales]\nlocale/*/strings.json = *\n',
+        ensure=True,
+    )
+    base = str(tmpdir.join('base'))
+    metadata = packager.readMetadata(base, 'chrome')
+    sources = [os.path.normpath(path)
+               for path in packager.get_devenv_sources(base, metadata)]
+    assert sources == [
+        base,
+        str(tmpdir.join('dependency', 'metadata.common')),
+        str(tmpdir.join('base', 'metadata.chrome')),
+        str(tmpdir.join('dependency', 'lib', 'mapped.js')),
+        str(tmpdir.join('dependency', 'locale')),
+    ]
+
+
+def test_write_directory_links_source_files(srcdir, tmpdir, monkeypatch):
+    # Reflinks aren't supported on all file systems, use hardlinks instead.
+    monkeypatch.setattr(packager, 'fcntl', None)
+    output = tmpdir.join('devenv')
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+
+    calls = []
+    files = read_files(srcdir, cache, calls)
+    files['generated.js'] = 'var generated;'
+    cache.save()
+    files.write_directory(str(output))
+    assert output.join('ui', 'index.html').samefile(
+        srcdir.join('ui', 'index.html'),
+    )
+    assert output.join('lib', 'foo.js').read() == 'CONTENT OF LIB/FOO.JS'
+
+    # Processed files are loaded from the cache, but must not be hardlinked.
+    files = read_files(srcdir, cache, calls)
+    assert isinstance(dict.__getitem__(files, 'lib/foo.js'),
+                      packager.LazyFile)
+    output.remove()
+    files.write_directory(str(output))
+    assert output.join('lib', 'foo.js').read() == 'CONTENT OF LIB/FOO.JS'
+    assert os.stat(str(output.join('lib', 'foo.js'))).st_nlink == 1
+
+    def link(source, target):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', link)
+    output.remove()
+    files.write_directory(str(output))
+    assert not output.join('ui', 'index.html').samefile(
+        srcdir.join('ui', 'index.html'),
+    )
+    assert output.join('ui', 'index.html').read() == 'content of ui/index.html'
+
+
+def test_cache_path_is_outside_of_the_repository(tmpdir, monkeypatch):
+    monkeypatch.setenv('BUILDTOOLS_CACHE_DIR', str(tmpdir.join('caches')))
+    first = packager.get_cache_path(str(tmpdir.join('a')))
+    second = packager.get_cache_path(str(tmpdir.join('b')))
+    assert os.path.dirname(first) == str(tmpdir.join('caches'))
+    assert first != second
+
+    monkeypatch.delenv('BUILDTOOLS_CACHE_DIR')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('xdg')))
+    assert packager.get_cache_path(str(tmpdir.join('a'))).startswith(
+        str(tmpdir.join('xdg', 'adblockplus-buildtools')),
+    )
+
+
+def test_compressed_data_is_stored_for_the_contents_read(srcdir, tmpdir):
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+    files = packager.Files({'lib', 'ui'}, set(), cache=cache)
+    files.read(str(srcdir))
+    digest = dict.__getitem__(files, 'lib/foo.js').digest
+
+    # The file is modified after its digest was calculated.
+    srcdir.join('lib', 'foo.js').write('modified during the build')
+    with zipfile.ZipFile(StringIO(files.zipToString())) as zip_file:
+        assert zip_file.read('lib/foo.js') == 'modified during the build'
+
+    assert cache.get_compressed(digest, zipfile.ZIP_DEFLATED) is None
+    modified_digest = hashlib.sha1('modified during the build').hexdigest()
+    assert cache.get_compressed(modified_digest,
+                                zipfile.ZIP_DEFLATED) is not None
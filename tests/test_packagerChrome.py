@@ -0,0 +1,550 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import json
+import os
+import sys
+import time
+import zipfile
+from StringIO import StringIO
+from struct import unpack
+
+import pytest
+from Crypto.Hash import SHA
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from buildtools import packager, packagerChrome
+
+
+@pytest.fixture
+def files():
+    files = packager.Files(set(), set())
+    files['manifest.json'] = '{}'
+    files['lib/foo.js'] = 'var foo;' * 1000
+    return files
+
+
+@pytest.fixture
+def keyfile():
+    return os.path.join(os.path.dirname(__file__), 'chrome_rsa.pem')
+
+
+def test_write_signed_package(files, keyfile, tmpdir):
+    path = str(tmpdir.join('package.crx'))
+    packagerChrome.write_package(path, files, keyfile)
+
+    with open(path, 'rb') as fp:
+        content = fp.read()
+
+    magic, version, l_pubkey, l_signature = unpack('<4sIII', content[:16])
+    assert (magic, version) == ('Cr24', 2)
+
+    with open(keyfile, 'rb') as fp:
+        key = RSA.importKey(fp.read())
+    pubkey = content[16:16 + l_pubkey]
+    assert pubkey == key.publickey().exportKey('DER')
+
+    signature = content[16 + l_pubkey:16 + l_pubkey + l_signature]
+    zipdata = content[16 + l_pubkey + l_signature:]
+    assert PKCS1_v1_5.new(key).verify(SHA.new(zipdata), signature)
+
+    with zipfile.ZipFile(StringIO(zipdata)) as zip_file:
+        assert zip_file.testzip() is None
+        assert sorted(zip_file.namelist()) == ['lib/foo.js', 'manifest.json']
+
+
+def test_write_package_keeps_previous_package_on_failure(files, tmpdir):
+    path = tmpdir.join('package.zip')
+    path.write('previous')
+    files['broken.js'] = None
+    with pytest.raises(Exception):
+        packagerChrome.write_package(str(path), files)
+    assert path.read() == 'previous'
+    assert tmpdir.listdir() == [path]
+
+
+def test_write_package_with_deprecated_functions(files, keyfile, tmpdir):
+    zipdata = files.zipToString()
+    path = str(tmpdir.join('package.crx'))
+    packagerChrome.writePackage(path, packagerChrome.getPublicKey(keyfile),
+                                packagerChrome.signBinary(zipdata, keyfile),
+                                zipdata)
+
+    expected = str(tmpdir.join('expected.crx'))
+    packagerChrome.write_package(expected, files, keyfile)
+    with open(path, 'rb') as file, open(expected, 'rb') as expected_file:
+        assert file.read() == expected_file.read()
+
+
+def test_write_unsigned_package(files):
+    output = StringIO()
+    packagerChrome.write_package(output, files)
+
+    output.seek(0)
+    with zipfile.ZipFile(output) as zip_file:
+        assert zip_file.read('lib/foo.js') == files['lib/foo.js']
+
+
+FAKE_WEBPACK_RUNNER = """
+import json
+import os
+import sys
+
+log_path, mode = sys.argv[1:]
+# Only the first process misbehaves.
+first = not os.path.exists(log_path)
+with open(log_path, 'a') as log:
+    log.write('start\\n')
+
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    with open(log_path, 'a') as log:
+        log.write(request['type'] + '\\n')
+    response = {'id': request['id']}
+    if request['type'] == 'ping':
+        if first and mode == 'silent':
+            continue
+        response['result'] = 'pong'
+    elif (first or mode == 'always_crash') and mode.endswith('crash'):
+        sys.exit(1)
+    elif mode == 'error':
+        response['error'] = 'Module not found'
+    else:
+        response['result'] = {'files': [], 'included': []}
+    sys.stdout.write(json.dumps(response) + '\\n')
+    sys.stdout.flush()
+"""
+
+
+@pytest.fixture
+def webpack_worker(tmpdir):
+    script = tmpdir.join('fake_webpack_runner.py')
+    script.write(FAKE_WEBPACK_RUNNER)
+    log = tmpdir.join('log')
+
+    def create(mode):
+        worker = packagerChrome.WebpackWorker()
+        worker.COMMAND = [sys.executable, str(script), str(log), mode]
+        worker.PING_TIMEOUT = 0.5
+        return worker
+
+    yield create, lambda: log.read().split()
+
+
+def test_webpack_worker_restarts_after_crash(webpack_worker):
+    create, get_log = webpack_worker
+    worker = create('crash')
+    try:
+        assert worker.run({}) == {'files': [], 'included': []}
+        assert get_log() == ['start', 'build', 'start', 'build']
+    finally:
+        worker.stop()
+
+
+def test_webpack_worker_restarts_without_pong(webpack_worker):
+    create, get_log = webpack_worker
+    worker = create('silent')
+    try:
+        worker.run({})
+        process = worker._process
+        assert worker.run({}) == {'files': [], 'included': []}
+        assert worker._process is not process
+        assert get_log() == ['start', 'build', 'ping', 'start', 'build']
+
+        # Healthy processes are reused.
+        worker.run({})
+        assert get_log()[-2:] == ['ping', 'build']
+    finally:
+        worker.stop()
+
+
+def test_webpack_worker_gives_up(webpack_worker):
+    create, get_log = webpack_worker
+    worker = create('error')
+    with pytest.raises(packagerChrome.WebpackError) as exc_info:
+        worker.run({})
+    worker.stop()
+    assert str(exc_info.value) == 'Module not found'
+    assert get_log() == ['start', 'build']
+
+    worker = create('always_crash')
+    with pytest.raises(packagerChrome.WebpackError):
+        worker.run({})
+    worker.stop()
+    assert get_log()[2:] == ['start', 'build', 'start', 'build']
+
+
+class FakeWebpackWorker(object):
+    """Create bundles like webpack_runner.js, with fixed contents."""
+
+    def __init__(self):
+        self.runs = 0
+        self.bundles = []
+
+    def run(self, configuration):
+        self.runs += 1
+        names = [bundle['bundle_name'] for bundle in configuration['bundles']]
+        self.bundles.extend(names)
+        if 'shared_bundle' in configuration:
+            names.append(configuration['shared_bundle']['bundle_name'])
+
+        files = []
+        for name in names:
+            for output, data in [(name, 'bundle'), (name + '.map', '{}')]:
+                path = os.path.join(configuration['output_path'],
+                                    *output.split('/'))
+                # Workers might run in parallel, sharing the output path.
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                with open(path, 'wb') as file:
+                    file.write(data)
+                files.append(output)
+
+        modules = {}
+        for bundle in configuration['bundles']:
+            modules[bundle['bundle_name']] = {
+                os.path.relpath(path, configuration['extension_path']):
+                    [6, None]
+                for path in bundle['entry_points']
+            }
+        result = {
+            'files': files,
+            'included': sorted({path for bundle in modules.values()
+                                for path in bundle}),
+        }
+        if configuration.get('report'):
+            result['modules'] = modules
+        return result
+
+
+def test_run_webpack_workers(tmpdir, monkeypatch):
+    workers = [FakeWebpackWorker() for i in range(3)]
+    monkeypatch.setattr(packagerChrome, 'get_webpack_workers',
+                        lambda count: workers[:count])
+    names = ['lib/{}.js'.format(i) for i in range(5)]
+    configuration = {
+        'bundles': [{'bundle_name': name,
+                     'entry_points': [str(tmpdir.join('src', name))]}
+                    for name in names],
+        'extension_path': str(tmpdir),
+        'output_path': str(tmpdir.join('output')),
+        'report': True,
+    }
+
+    output = packagerChrome.run_webpack_workers(configuration, 3)
+    assert [worker.bundles for worker in workers] == [
+        ['lib/0.js', 'lib/3.js'], ['lib/1.js', 'lib/4.js'], ['lib/2.js'],
+    ]
+    assert sorted(output['files']) == sorted(
+        names + [name + '.map' for name in names],
+    )
+    assert output['included'] == ['src/' + name for name in names]
+    assert sorted(output['modules']) == names
+    assert output['modules']['lib/3.js'] == {'src/lib/3.js': [6, None]}
+
+    # There are never more workers than bundles.
+    output = packagerChrome.run_webpack_workers(
+        dict(configuration, bundles=configuration['bundles'][:2]), 3,
+    )
+    assert [worker.runs for worker in workers] == [2, 2, 1]
+
+    # Bundles sharing a bundle are all created by the same worker.
+    configuration['shared_bundle'] = {'bundle_name': 'lib/shared.js',
+                                      'bundles': names}
+    output = packagerChrome.run_webpack_workers(configuration, 3)
+    assert [worker.runs for worker in workers] == [3, 2, 1]
+    assert workers[0].bundles[-5:] == names
+    assert 'lib/shared.js' in output['files']
+
+
+def test_create_bundles_reuses_cached_bundles(tmpdir, monkeypatch):
+    tmpdir.join('metadata.chrome').write(
+        '[general]\nbasename = test\n[bundles]\nlib/foo.js = lib/a.js\n',
+    )
+    module = tmpdir.join('lib', 'a.js')
+    module.write('var a;', ensure=True)
+    module.setmtime(time.time() - 60)
+
+    worker = FakeWebpackWorker()
+    monkeypatch.setattr(packagerChrome, 'get_webpack_workers',
+                        lambda count: [worker] * count)
+    params = {
+        'type': 'chrome',
+        'baseDir': str(tmpdir),
+        'version': '1.0',
+        'releaseBuild': False,
+        'devenv': False,
+        'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+        'webpackWorkers': None,
+    }
+
+    def bundle():
+        cache = packager.FileCache(str(tmpdir.join('cache')))
+        files = packager.Files({'lib'}, set(), cache=cache)
+        files.read(str(tmpdir))
+        packagerChrome.create_bundles(params, files, False)
+        cache.save()
+        return files
+
+    for runs in [1, 1]:
+        files = bundle()
+        assert worker.runs == runs
+        assert sorted(files) == ['lib/foo.js', 'lib/foo.js.map']
+        assert files['lib/foo.js'] == 'bundle'
+
+    module.write('var b;')
+    module.setmtime(time.time() - 30)
+    bundle()
+    assert worker.runs == 2
+
+    params['version'] = '1.1'
+    bundle()
+    assert worker.runs == 3
+
+    files = packager.Files({'lib'}, set())
+    packagerChrome.create_bundles(params, files, False)
+    assert worker.runs == 4
+    assert files['lib/foo.js.map'] == '{}'
+
+
+def test_create_bundles_ignores_modules_changed_while_bundling(tmpdir,
+                                                               monkeypatch):
+    tmpdir.join('metadata.chrome').write(
+        '[general]\nbasename = test\n[bundles]\nlib/foo.js = lib/a.js\n',
+    )
+    module = tmpdir.join('lib', 'a.js')
+    module.write('v1', ensure=True)
+    module.setmtime(time.time() - 60)
+
+    class EditingWebpackWorker(FakeWebpackWorker):
+        def run(self, configuration):
+            result = FakeWebpackWorker.run(self, configuration)
+            module.write('v2')
+            return result
+
+    worker = EditingWebpackWorker()
+    monkeypatch.setattr(packagerChrome, 'get_webpack_workers',
+                        lambda count: [worker] * count)
+    params = {
+        'type': 'chrome',
+        'baseDir': str(tmpdir),
+        'version': '1.0',
+        'releaseBuild': False,
+        'devenv': False,
+        'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+        'webpackWorkers': None,
+    }
+
+    for runs in [1, 2]:
+        cache = packager.FileCache(str(tmpdir.join('cache')))
+        files = packager.Files({'lib'}, set(), cache=cache)
+        packagerChrome.create_bundles(params, files, False)
+        cache.save()
+        assert worker.runs == runs
+        assert files['lib/foo.js'] == 'bundle'
+
+
+def test_bundle_options(tmpdir):
+    tmpdir.join('metadata.chrome').write(
+        '[general]\nbasename = test\n'
+        '[bundle_release]\nminify = false\nsourceMaps = separate\n',
+    )
+    params = {
+        'releaseBuild': True,
+        'devenv': False,
+        'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+    }
+    assert packagerChrome.get_bundle_options(params) == {
+        'minify': False,
+        'concatenate_modules': True,
+        'source_maps': 'separate',
+    }
+
+    params['devenv'] = True
+    options = packagerChrome.get_bundle_options(params)
+    assert options['source_maps'] == 'package'
+
+
+def test_write_source_maps(tmpdir):
+    path = str(tmpdir.join('test-1.0.crx'))
+    packagerChrome.write_source_maps(path, {'lib/foo.js.map': '{}'})
+
+    path = str(tmpdir.join('test-1.0-sourcemaps.zip'))
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.read('lib/foo.js.map') == '{}'
+
+
+def test_add_shared_bundle(tmpdir):
+    tmpdir.join('metadata.chrome').write(
+        '[general]\nbasename = test\nsharedBundle = lib/shared.js\n'
+        '[bundles]\nlib/a.js = a.js\nlib/b.js = b.js\n',
+    )
+    params = {
+        'baseDir': str(tmpdir),
+        'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+    }
+
+    scripts = ['polyfill.js', 'lib/a.js', 'lib/b.js']
+    assert packagerChrome.add_shared_bundle(params, scripts) == [
+        'polyfill.js', 'lib/shared.js', 'lib/a.js', 'lib/b.js',
+    ]
+    assert packagerChrome.add_shared_bundle(
+        params, ['../lib/b.js'], 'qunit',
+    ) == ['../lib/shared.js', '../lib/b.js']
+    assert packagerChrome.add_shared_bundle(params, ['x.js']) == ['x.js']
+
+
+def test_native_bundler_falls_back_for_shared_bundle(tmpdir, capsys):
+    metadata = tmpdir.join('metadata.chrome')
+    metadata.write(
+        '[general]\nbasename = test\ndevenvBundler = native\n'
+        '[bundles]\nlib/a.js = a.js\nlib/b.js = b.js\n',
+    )
+    params = {
+        'devenv': True,
+        'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+    }
+    assert packagerChrome.use_native_bundler(params)
+
+    metadata.write('[general]\nsharedBundle = lib/shared.js\n', mode='a')
+    params['metadata'] = packager.readMetadata(str(tmpdir), 'chrome')
+    assert not packagerChrome.use_native_bundler(params)
+    assert 'using webpack instead' in capsys.readouterr()[1]
+
+
+def test_bundle_report(tmpdir, capsys):
+    metadata = tmpdir.join('metadata.chrome')
+    metadata.write(
+        '[general]\nbasename = test\n'
+        '[bundle_budgets]\nlib/foo.js = 1k\n'
+        '[bundle_report]\nbaseline = baseline.json\nmaxGrowth = 50\n',
+    )
+    files = packager.Files(set(), set())
+    files['lib/foo.js'] = 'var foo;' * 100
+    report = packagerChrome.create_bundle_report(files, {
+        'lib/foo.js': {'lib/foo.js': [800, 20], 'lib/bar.js': [20, None]},
+    })
+    assert report['lib/foo.js']['size'] == 800
+    assert report['lib/foo.js']['compressed'] < 800
+    assert report['lib/foo.js']['modules']['lib/bar.js'] == {
+        'size': 20, 'compressed': None,
+    }
+
+    params = {
+        'baseDir': str(tmpdir),
+        'metadata': packager.readMetadata(str(tmpdir), 'chrome'),
+    }
+    packagerChrome.check_bundle_report(params, report)
+
+    baseline = {'lib/foo.js': {'size': 100, 'compressed': 10,
+                               'modules': {'lib/foo.js': {'size': 100,
+                                                          'compressed': 10}}}}
+    tmpdir.join('baseline.json').write(json.dumps(baseline))
+    with pytest.raises(Exception) as exc_info:
+        packagerChrome.check_bundle_report(params, report)
+    assert 'lib/foo.js grew by' in str(exc_info.value)
+    assert 'lib/bar.js +20' in str(exc_info.value)
+
+    metadata.write('[bundle_report]\naction = warn\n', mode='a')
+    params['metadata'] = packager.readMetadata(str(tmpdir), 'chrome')
+    packagerChrome.check_bundle_report(params, report)
+    assert 'Warning: lib/foo.js grew by' in capsys.readouterr()[1]
+
+    metadata.write('[bundle_budgets]\nlib/missing.js = 1k\n', mode='a')
+    params['metadata'] = packager.readMetadata(str(tmpdir), 'chrome')
+    packagerChrome.check_bundle_report(params, report)
+    assert ('Warning: There is a budget for lib/missing.js, but no such '
+            'bundle') in capsys.readouterr()[1]
+
+
+def test_read_locale_source_keeps_latest_contents(tmpdir, monkeypatch):
+    monkeypatch.setattr(packagerChrome.read_locale_source, 'sources', {})
+    path = tmpdir.join('messages.json')
+    path.write('{"foo": {"message": "foo"}}')
+    path.setmtime(time.time() - 60)
+    assert packagerChrome.read_locale_source(str(path)) == {
+        'foo': {'message': 'foo'},
+    }
+
+    path.write('{"bar": {"message": "bar"}}')
+    assert packagerChrome.read_locale_source(str(path)) == {
+        'bar': {'message': 'bar'},
+    }
+    assert len(packagerChrome.read_locale_source.sources) == 1
+
+
+def test_module_index(tmpdir, monkeypatch):
+    for name in ['lib/foo.js', 'lib/ext/common.js', 'lib/dir/index.js',
+                 'lib/data.json', 'core/lib/foo.js', 'core/lib/bar.js']:
+        tmpdir.join(*name.split('/')).write('', ensure=True)
+    mtime = time.time() - 60
+    for dirpath, dirnames, filenames in os.walk(str(tmpdir)):
+        os.utime(dirpath, (mtime, mtime))
+
+    lib = str(tmpdir.join('lib'))
+    core_lib = str(tmpdir.join('core', 'lib'))
+    resolve_paths = [lib, core_lib, str(tmpdir.join('missing'))]
+    cache = packager.FileCache(str(tmpdir.join('cache')))
+    index = packagerChrome.get_module_index(resolve_paths, cache)
+    assert index == {
+        'foo$': os.path.join(lib, 'foo.js'),
+        'foo.js$': os.path.join(lib, 'foo.js'),
+        'bar$': os.path.join(core_lib, 'bar.js'),
+        'bar.js$': os.path.join(core_lib, 'bar.js'),
+        'ext/common$': os.path.join(lib, 'ext', 'common.js'),
+        'ext/common.js$': os.path.join(lib, 'ext', 'common.js'),
+        'ext_common$': os.path.join(lib, 'ext', 'common.js'),
+        'ext_common.js$': os.path.join(lib, 'ext', 'common.js'),
+        'dir/index$': os.path.join(lib, 'dir', 'index.js'),
+        'dir/index.js$': os.path.join(lib, 'dir', 'index.js'),
+        'dir_index$': os.path.join(lib, 'dir', 'index.js'),
+        'dir_index.js$': os.path.join(lib, 'dir', 'index.js'),
+    }
+
+    def scan_modules(root, directories):
+        raise AssertionError('The module index should have been cached')
+
+    scan = packagerChrome.scan_modules
+    monkeypatch.setattr(packagerChrome, 'scan_modules', scan_modules)
+    assert packagerChrome.get_module_index(resolve_paths, cache) == index
+
+    tmpdir.join('lib', 'ext', 'new.js').write('')
+    monkeypatch.setattr(packagerChrome, 'scan_modules', scan)
+    index = packagerChrome.get_module_index(resolve_paths, cache)
+    assert index['ext_new$'] == os.path.join(lib, 'ext', 'new.js')
+
+
+def test_devenv_version_depends_on_contents(tmpdir):
+    tmpdir.join('metadata.chrome').write('[general]\nbasename = test\n')
+    metadata = packager.readMetadata(str(tmpdir), 'chrome')
+
+    def build(contents, server=None):
+        files = packager.Files(set(), set())
+        files.update(contents)
+        version = packagerChrome.add_devenv_requirements(
+            files, metadata, {'devenvServer': server},
+        )
+        assert version == files['devenvVersion__']
+        return files
+
+    contents = {'manifest.json': '{}', 'lib/foo.js': 'var foo;'}
+    first = build(contents)
+    assert build(contents)['devenvVersion__'] == first['devenvVersion__']
+
+    digests = json.loads(first['devenvFiles__'])
+    assert sorted(digests) == ['devenvPoller__.js', 'lib/foo.js',
+                               'manifest.json']
+    assert digests['lib/foo.js'] == first.get_digest('lib/foo.js')
+
+    contents['lib/foo.js'] = 'var bar;'
+    assert build(contents)['devenvVersion__'] != first['devenvVersion__']
+
+    server = 'http://127.0.0.1:8000/'
+    assert build(contents, server)['devenvServer__'] == server
+    assert 'devenvServer__' not in first
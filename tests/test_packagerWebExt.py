@@ -166,6 +166,12 @@ def assert_all_locales_present(package, prefix):
     }
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    """Keep the build cache out of the user's home directory."""
+    monkeypatch.setenv('BUILDTOOLS_CACHE_DIR', str(tmpdir.join('.cache')))
+
+
 @pytest.fixture
 def srcdir(tmpdir):
     """Source directory for building the package."""
@@ -496,3 +502,18 @@ def test_build_webext(platform, command, keyfile, tmpdir, srcdir, capsys):
                 package.read(os.path.join(folder, '{}.{}'.format(name, ext))),
                 expected,
             )
+
+
+def test_key_file_only_signs_chrome_builds(tmpdir, gecko_webext_metadata,
+                                           keyfile, monkeypatch):
+    from buildtools import packagerChrome
+
+    calls = []
+
+    def create_build(base_dir, type, **kwargs):
+        calls.append((type, kwargs['keyFile']))
+
+    monkeypatch.setattr(packagerChrome, 'createBuild', create_build)
+    process_args(str(tmpdir), 'build', '-t', 'chrome', '-t', 'gecko',
+                 '-k', keyfile)
+    assert sorted(calls) == [('chrome', keyfile), ('gecko', None)]
@@ -0,0 +1,84 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+from buildtools import profiler
+
+
+@pytest.fixture
+def active_profiler(monkeypatch):
+    # Make sure profiling is disabled again after the test.
+    monkeypatch.setattr(profiler, '_events', None)
+    profiler.start()
+
+
+def test_inactive_profiler_records_nothing(monkeypatch):
+    monkeypatch.setattr(profiler, '_events', None)
+    with profiler.stage('read files'):
+        pass
+    assert not profiler.is_active()
+
+
+@pytest.mark.usefixtures('active_profiler')
+def test_trace_and_summary(tmpdir):
+    with profiler.stage('build chrome'):
+        with profiler.stage('read files', count=3):
+            pass
+        with pytest.raises(ValueError):
+            with profiler.stage('create bundles'):
+                raise ValueError()
+
+    path = str(tmpdir.join('trace.json'))
+    profiler.write_trace(path)
+    with open(path) as fp:
+        events = json.load(fp)['traceEvents']
+
+    assert [event['name'] for event in events] == [
+        'read files', 'create bundles', 'build chrome',
+    ]
+    for event in events:
+        assert event['ph'] == 'X'
+        assert event['dur'] >= 0
+        assert event['args']['peak_memory_kib'] > 0
+        assert event['args']['peak_memory_growth_kib'] >= 0
+    assert events[0]['args']['count'] == 3
+
+    summary = profiler.format_summary().splitlines()
+    assert summary[1].startswith('build chrome ')
+    assert summary[2].startswith('  read files ')
+    assert summary[3].startswith('  create bundles ')
+
+
+@pytest.mark.usefixtures('active_profiler')
+def test_summary_shows_peak_memory_growth(monkeypatch):
+    peaks = iter([1024, 1024, 3072, 3072, 3072, 4096])
+    monkeypatch.setattr(profiler, '_get_peak_memory',
+                        lambda: [next(peaks), None])
+    with profiler.stage('build chrome'):
+        with profiler.stage('create bundles'):
+            pass
+        with profiler.stage('write package'):
+            pass
+
+    summary = profiler.format_summary().splitlines()
+    assert summary[0].endswith(' Peak+ (MiB)')
+    assert summary[1].startswith('build chrome ')
+    assert summary[1].endswith(' 3.0')
+    assert summary[2].endswith(' 2.0')
+    # The peak can't decrease, but isn't raised by every stage.
+    assert summary[3].endswith(' 0.0')
+
+
+@pytest.mark.usefixtures('active_profiler')
+def test_profiling_without_resource_module(monkeypatch):
+    monkeypatch.setattr(profiler, 'resource', None)
+    with profiler.stage('build chrome'):
+        pass
+
+    summary = profiler.format_summary().splitlines()
+    assert summary[1].startswith('build chrome ')
+    assert summary[1].endswith(' n/a')
@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import urllib2
+
+import pytest
+
+from buildtools.reloadserver import ReloadServer
+
+
+@pytest.fixture
+def server():
+    server = ReloadServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_responds_once_the_version_changed(server):
+    server.set_version('1')
+    response = urllib2.urlopen(server.url + '?version=0')
+    assert response.info()['Access-Control-Allow-Origin'] == '*'
+    assert response.read() == '1'
+
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(
+        urllib2.urlopen(server.url + '?version=1').read(),
+    ))
+    thread.start()
+    thread.join(0.2)
+    assert responses == []
+
+    server.set_version('2')
+    thread.join(5)
+    assert responses == ['2']
+
+
+def test_wait_times_out(server):
+    assert server.wait_for_version('1', timeout=0.01) == '1'
+    server.set_version('1')
+    assert server.wait_for_version('1', timeout=0.01) == '1'
@@ -0,0 +1,56 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+import pytest
+
+from buildtools import watcher
+
+
+@pytest.fixture
+def polling(monkeypatch):
+    monkeypatch.setattr(watcher, 'pyinotify', None)
+    monkeypatch.setattr(watcher, 'POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(watcher, 'DEBOUNCE_DELAY', 0.01)
+
+
+def touch(path, data):
+    path.write(data, ensure=True)
+    # Make sure that the change is noticed despite coarse timestamps.
+    path.setmtime(time.time() + 10)
+
+
+def test_polling_watcher(tmpdir, polling):
+    base = tmpdir.join('base')
+    base.join('lib', 'foo.js').write('', ensure=True)
+    base.join('devenv.chrome', 'lib', 'foo.js').write('', ensure=True)
+    metadata = tmpdir.join('dependency', 'metadata.common')
+    metadata.write('', ensure=True)
+    tmpdir.join('dependency', 'other').write('')
+
+    file_watcher = watcher.create_watcher([
+        str(base), str(base.join('lib')), str(metadata),
+    ])
+    assert isinstance(file_watcher, watcher.PollingWatcher)
+    assert file_watcher.directories == [str(base)]
+    assert file_watcher.files == [str(metadata)]
+
+    touch(base.join('devenv.chrome', 'lib', 'foo.js'), 'ignored')
+    for name in ['test-1.2.3.crx', 'test-1.2.3-sourcemaps.zip',
+                 'test-1.2.3-bundles.json', 'tmpabcdef.tmp']:
+        touch(base.join(name), 'build output')
+    touch(tmpdir.join('dependency', 'other'), 'not watched')
+    touch(base.join('lib', 'foo.js'), 'changed')
+    touch(base.join('lib', 'new.js'), 'added')
+    assert watcher.wait_for_changes(file_watcher) == {
+        str(base.join('lib', 'foo.js')), str(base.join('lib', 'new.js')),
+    }
+
+    base.join('lib', 'new.js').remove()
+    touch(metadata, 'changed')
+    assert watcher.wait_for_changes(file_watcher) == {
+        str(base.join('lib', 'new.js')), str(metadata),
+    }
+    assert file_watcher.read_changes(0) == set()
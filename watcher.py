@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Wait for changes to source files, e.g. for `build.py devenv --watch`.
+
+Changes are detected with inotify if pyinotify is installed, otherwise the
+watched files are polled for changes of their size and modification time.
+"""
+
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Interval (in seconds) in which files are checked for changes, if inotify
+# isn't available.
+POLL_INTERVAL = 0.5
+
+# Changes are collected until there were no further changes for this long
+# (in seconds), so that saving multiple files only results in one rebuild.
+DEBOUNCE_DELAY = 0.1
+
+# Directories which aren't relevant for the build.
+IGNORED_NAMES = {'.git', '.hg', 'node_modules'}
+
+# Build output written next to the sources, i.e. packages, their source maps
+# and bundle reports, as well as temporary files while writing them.
+IGNORED_SUFFIXES = ('.appx', '.crx', '.xpi', '.zip', '-bundles.json', '.tmp')
+
+
+def is_ignored(name):
+    if name in IGNORED_NAMES or name.startswith('devenv.'):
+        return True
+    return name.endswith(IGNORED_SUFFIXES)
+
+
+def _contains(directory, path):
+    return path.startswith(os.path.join(directory, ''))
+
+
+def _is_ignored_path(directory, path):
+    relpath = os.path.relpath(path, directory)
+    return any(is_ignored(name) for name in relpath.split(os.sep))
+
+
+def _normalize(paths):
+    """Split `paths` into directories to watch recursively and other files.
+
+    Paths inside of other directories which are watched are skipped.
+    """
+    paths = sorted({os.path.abspath(path) for path in paths})
+    directories = []
+    files = []
+    for path in paths:
+        if any(_contains(directory, path) for directory in directories):
+            continue
+        if os.path.isdir(path):
+            directories.append(path)
+        else:
+            files.append(path)
+    files = [path for path in files
+             if not any(_contains(directory, path)
+                        for directory in directories)]
+    return directories, files
+
+
+class PollingWatcher(object):
+    def __init__(self, directories, files):
+        self.directories = directories
+        self.files = files
+        self._state = self._scan()
+
+    def _scan(self):
+        paths = list(self.files)
+        for root in self.directories:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [name for name in dirnames
+                               if not is_ignored(name)]
+                paths.extend(os.path.join(dirpath, name)
+                             for name in filenames if not is_ignored(name))
+
+        state = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (stat.st_size, stat.st_mtime)
+        return state
+
+    def read_changes(self, timeout=None):
+        """Return the paths changed since the last call.
+
+        Unless a `timeout` (in seconds) is given, this blocks until there
+        are changes.
+        """
+        while True:
+            time.sleep(POLL_INTERVAL if timeout is None else timeout)
+            state = self._scan()
+            changes = {path for path in set(state).union(self._state)
+                       if state.get(path) != self._state.get(path)}
+            self._state = state
+            if changes or timeout is not None:
+                return changes
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    EVENTS = ['IN_CLOSE_WRITE', 'IN_CREATE', 'IN_DELETE', 'IN_MOVED_FROM',
+              'IN_MOVED_TO']
+
+    def __init__(self, directories, files):
+        self.directories = directories
+        self.files = set(files)
+        self._changes = set()
+        self._manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._manager, self._add_change)
+
+        mask = 0
+        for name in self.EVENTS:
+            mask |= getattr(pyinotify, name)
+
+        def exclude(path):
+            return is_ignored(os.path.basename(path))
+
+        for path in directories:
+            self._manager.add_watch(path, mask, rec=True, auto_add=True,
+                                    exclude_filter=exclude)
+        # Files are watched through their directory, so that they are still
+        # watched after being replaced, like editors commonly do on save.
+        for path in {os.path.dirname(path) for path in files}:
+            if os.path.isdir(path):
+                self._manager.add_watch(path, mask)
+
+    def _add_change(self, event):
+        path = event.pathname
+        if path in self.files:
+            self._changes.add(path)
+            return
+        for directory in self.directories:
+            if path == directory or _contains(directory, path):
+                if not _is_ignored_path(directory, path):
+                    self._changes.add(path)
+                return
+
+    def read_changes(self, timeout=None):
+        """Return the paths changed since the last call.
+
+        Unless a `timeout` (in seconds) is given, this blocks until there
+        are changes.
+        """
+        while not self._changes:
+            if timeout is None:
+                ready = self._notifier.check_events()
+            else:
+                ready = self._notifier.check_events(int(timeout * 1000))
+            if ready:
+                self._notifier.read_events()
+                self._notifier.process_events()
+            elif timeout is not None:
+                break
+
+        changes = self._changes
+        self._changes = set()
+        return changes
+
+    def close(self):
+        self._notifier.stop()
+
+
+def create_watcher(paths):
+    """Return a watcher for the given files and directories.
+
+    Directories are watched recursively, ignoring build output.
+    """
+    directories, files = _normalize(paths)
+    if pyinotify:
+        return InotifyWatcher(directories, files)
+    return PollingWatcher(directories, files)
+
+
+def wait_for_changes(watcher):
+    """Block until files changed, and return the paths of changed files."""
+    changes = watcher.read_changes()
+    while True:
+        more = watcher.read_changes(DEBOUNCE_DELAY)
+        if not more:
+            return changes
+        changes.update(more)
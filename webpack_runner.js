@@ -4,23 +4,121 @@
 
 "use strict";
 
+const crypto = require("crypto");
+const fs = require("fs");
 const path = require("path");
 const process = require("process");
+const readline = require("readline");
+const zlib = require("zlib");
 
+const HardSourceWebpackPlugin = require("hard-source-webpack-plugin");
 const MemoryFS = require("memory-fs");
+const UglifyJsPlugin = require("uglifyjs-webpack-plugin");
 const webpack = require("webpack");
 
-// We read the configuration from STDIN rather than as an argument to improve
-// the output on error. Otherwise the (fairly huge) configuration is printed
-// along with the actual error message.
-let inputChunks = [];
-process.stdin.setEncoding("utf-8");
-process.stdin.on("data", chunk => { inputChunks.push(chunk); });
-process.stdin.on("end", () =>
+// Every bundle configuration is cached in a directory of its own. Its
+// modification time is updated whenever it is used, so that FileCache.save()
+// in packager.py can remove the caches which haven't been used for a while.
+function getCacheDirectory(cacheDir, settings)
 {
-  let {bundles, extension_path,
-       info_module, resolve_paths, aliases} = JSON.parse(inputChunks.join(""));
+  let configHash = crypto.createHash("sha1")
+                         .update(JSON.stringify(settings))
+                         .digest("hex");
+  let directory = path.join(cacheDir, configHash);
+  let now = new Date();
+  try
+  {
+    fs.utimesSync(directory, now, now);
+  }
+  catch (e)
+  {
+    // The directory is created by the plugins below if it doesn't exist yet.
+  }
+  return {directory, configHash};
+}
+
+// Parsed modules, resolver results and generated code are cached on disk, so
+// that only modules which changed (and their dependants) are built again.
+function getCachePlugins({directory, configHash})
+{
+  return [
+    new HardSourceWebpackPlugin({
+      cacheDirectory: path.join(directory, "hard-source"),
+      configHash: () => configHash,
+      environmentHash: {
+        root: __dirname,
+        directories: [],
+        files: ["package.json", "webpack_runner.js", "info-loader.js"]
+      },
+      info: {
+        level: "warn"
+      }
+    }),
+    // The info module differs between builds (e.g. with the version), and
+    // must not be taken from the cache.
+    new HardSourceWebpackPlugin.ExcludeModulePlugin([{test: /info-loader/}])
+  ];
+}
+
+// Release builds can be optimized at the cost of a slower build. Separate
+// source maps are created but not referenced from the bundles, since they
+// don't end up in the package.
+function getBundleOptions({minify, concatenate_modules, source_maps},
+                          cache)
+{
+  let devtool = {
+    package: "source-map",
+    separate: "hidden-source-map",
+    none: false
+  }[source_maps];
+
+  let plugins = [];
+  if (concatenate_modules)
+    plugins.push(new webpack.optimize.ModuleConcatenationPlugin());
+  if (minify)
+  {
+    plugins.push(new UglifyJsPlugin({
+      cache: cache ? path.join(cache.directory, "uglify") : false,
+      parallel: true,
+      sourceMap: !!devtool
+    }));
+  }
+  return {devtool, plugins};
+}
+
+// Modules concatenated by the ModuleConcatenationPlugin are reported as one
+// module, listing the actual modules it consists of.
+function* getModules(modules)
+{
+  for (let module of modules)
+  {
+    if (module.modules)
+      yield* getModules(module.modules);
+    else if (!module.name.startsWith("multi "))
+      yield module;
+  }
+}
+
+// Usually, every bundle is created by a compiler of its own. However, the
+// bundles which share a bundle are created by the same compiler, so that
+// modules they have in common can be moved into the shared bundle.
+function groupBundles(bundles, sharedBundle)
+{
+  if (!sharedBundle)
+    return bundles.map(bundle => [bundle]);
+
+  let sharing = new Set(sharedBundle.bundles);
+  return [bundles.filter(bundle => sharing.has(bundle.bundle_name))].concat(
+    bundles.filter(bundle => !sharing.has(bundle.bundle_name))
+           .map(bundle => [bundle])
+  );
+}
 
+function runWebpack({bundles, extension_path, info_module, resolve_paths,
+                     aliases, module_index, bundle_options, shared_bundle,
+                     cache_dir, output_path, report},
+                    callback)
+{
   // The contents of the info module is passed to us as a string from the Python
   // packager and we pass it through to our custom loader now so it is available
   // at bundle time.
@@ -28,30 +126,77 @@ process.stdin.on("end", () =>
 
   // Since the cost of starting Node.js and loading all the modules is hugely
   // larger than actually producing bundles we avoid paying it multiple times,
-  // instead producing all the bundles in one go.
+  // instead producing all the bundles in one go (and, in server mode, reusing
+  // the process for subsequent builds).
   let options = [];
-  for (let {bundle_name, entry_points} of bundles)
+  let outputNames = [];
+  for (let group of groupBundles(bundles, shared_bundle))
   {
+    let entry = {};
+    let names = [];
+    for (let {bundle_name, entry_points} of group)
+    {
+      entry[bundle_name] = entry_points;
+      names.push(bundle_name);
+    }
+
+    let plugins = [];
+    let cache = null;
+    if (cache_dir)
+    {
+      // Resolved modules are cached as well, so the module index has to be
+      // part of the cache configuration. Otherwise, a module shadowing
+      // another one would be ignored.
+      let moduleIndex = Object.keys(module_index || {}).sort().map(
+        request => [request, module_index[request]]
+      );
+      cache = getCacheDirectory(cache_dir, {
+        group, extension_path, resolve_paths, aliases, bundle_options,
+        shared_bundle, moduleIndex
+      });
+      plugins = getCachePlugins(cache);
+    }
+    let {devtool, plugins: optimizations} = getBundleOptions(
+      bundle_options || {source_maps: "package"}, cache
+    );
+    if (shared_bundle && group.length > 0 &&
+        shared_bundle.bundles.includes(group[0].bundle_name))
+    {
+      // The shared bundle also contains webpack's runtime, so it has to be
+      // loaded before any of the bundles sharing it.
+      plugins.push(new webpack.optimize.CommonsChunkPlugin({
+        name: shared_bundle.bundle_name,
+        minChunks: 2
+      }));
+      names.push(shared_bundle.bundle_name);
+    }
+    if (names.length == 0)
+      continue;
+
+    outputNames.push(names);
     options.push({
       context: extension_path,
-      devtool: "source-map",
+      devtool,
       module: {
         rules: [{
           include: path.join(__dirname, "info.js"),
           use: ["info-loader"]
         }]
       },
-      entry: entry_points,
+      entry,
       output: {
-        path: path.resolve(""),
-        filename: bundle_name
+        path: output_path || path.resolve(""),
+        filename: "[name]"
       },
       node: {
         global: false
       },
+      plugins: plugins.concat(optimizations),
       resolve: {
         modules: resolve_paths,
-        alias: aliases,
+        // Most modules are resolved by the module index, without probing
+        // the resolve paths.
+        alias: Object.assign({}, module_index, aliases),
         plugins: [
           function()
           {
@@ -91,12 +236,18 @@ process.stdin.on("end", () =>
     });
   }
 
-  // Based on this example
+  // If an output directory is given, the bundles are written there and only
+  // their names are part of the output. Otherwise they are kept in memory
+  // and their contents are part of the output, based on this example
   // https://webpack.js.org/api/node/#custom-file-systems
-  let memoryFS = new MemoryFS();
+  let memoryFS = null;
   let webpackCompiler = webpack(options);
 
-  webpackCompiler.outputFileSystem = memoryFS;
+  if (!output_path)
+  {
+    memoryFS = new MemoryFS();
+    webpackCompiler.outputFileSystem = memoryFS;
+  }
   webpackCompiler.run((err, stats) =>
   {
     // Error handling is based on this example
@@ -106,43 +257,144 @@ process.stdin.on("end", () =>
       let reason = err.stack || err;
       if (err.details)
         reason += "\n" + err.details;
-      throw new Error(reason);
+      callback(new Error(reason));
     }
     else if (stats.hasErrors())
-      throw new Error(stats.toJson().errors.join("\n"));
+      callback(new Error(stats.toJson().errors.join("\n")));
     else
     {
       let output = {};
-      let files = output.files = {};
+      let files = output.files = memoryFS ? {} : [];
 
-      for (let config of options)
+      options.forEach((config, i) =>
       {
-        let filepath = path.join(config.output.path, config.output.filename);
-        let relativeFilepath = path.relative("", config.output.filename);
-        files[relativeFilepath] = memoryFS.readFileSync(filepath, "utf-8");
-        files[relativeFilepath + ".map"] = memoryFS.readFileSync(
-          filepath + ".map", "utf-8"
-        );
-      }
+        for (let bundleName of outputNames[i])
+        {
+          let filepath = path.join(config.output.path, bundleName);
+          let relativeFilepath = path.relative("", bundleName);
+          let outputFiles = [[relativeFilepath, filepath]];
+          if (config.devtool)
+            outputFiles.push([relativeFilepath + ".map", filepath + ".map"]);
+
+          for (let [name, outputPath] of outputFiles)
+          {
+            if (memoryFS)
+              files[name] = memoryFS.readFileSync(outputPath, "utf-8");
+            else
+              files.push(name);
+          }
+        }
+      });
 
       // We provide a list of all the bundled files, so the packager can avoid
       // including them again outside of a bundle. Otherwise we end up including
-      // duplicate copies in our builds.
+      // duplicate copies in our builds. For the bundle report, we also provide
+      // the size and compressed size of each module in each bundle.
       let included = new Set();
-      for (let bundle of stats.toJson().children)
+      if (report)
+        output.modules = {};
+      for (let bundle of stats.toJson({source: !!report}).children)
       {
         for (let chunk of bundle.chunks)
         {
-          for (let module of chunk.modules)
+          let bundleName = chunk.files.find(file => !file.endsWith(".map"));
+          let modules = {};
+          for (let module of getModules(chunk.modules))
           {
-            if (!module.name.startsWith("multi "))
-              included.add(path.relative(extension_path, module.name));
+            // Module names are relative to the context (i.e. extension_path),
+            // unless they are outside of it.
+            let relativePath = path.relative(
+              extension_path, path.resolve(extension_path, module.name)
+            );
+            included.add(relativePath);
+            if (report)
+            {
+              modules[relativePath] = [
+                module.size,
+                module.source ? zlib.deflateRawSync(module.source).length : null
+              ];
+            }
           }
+          if (report)
+            output.modules[path.relative("", bundleName)] = modules;
         }
       }
       output.included = Array.from(included);
 
-      console.log(JSON.stringify(output));
+      callback(null, output);
+    }
+  });
+}
+
+function respond(response)
+{
+  process.stdout.write(JSON.stringify(response) + "\n");
+}
+
+function handleRequest({id, type, configuration})
+{
+  return new Promise(resolve =>
+  {
+    let done = (err, result) =>
+    {
+      if (err)
+        respond({id, error: String(err.stack || err)});
+      else
+        respond({id, result});
+      resolve();
+    };
+
+    if (type == "ping")
+      return done(null, "pong");
+    if (type != "build")
+      return done(new Error("Unknown request type: " + type));
+
+    try
+    {
+      runWebpack(configuration, done);
+    }
+    catch (e)
+    {
+      done(e);
     }
   });
-});
+}
+
+if (process.argv.includes("--server"))
+{
+  // In server mode we read one JSON request per line from STDIN, and write
+  // one JSON response per line to STDOUT, until STDIN is closed. Requests are
+  // handled one at a time, in the order they were received. Anything else
+  // webpack or its plugins log goes to STDERR, so that it can't be confused
+  // with a response.
+  console.log = console.info = console.error;
+
+  let requests = Promise.resolve();
+  let lines = readline.createInterface({input: process.stdin});
+  lines.on("line", line =>
+  {
+    if (!line.trim())
+      return;
+
+    let request = JSON.parse(line);
+    requests = requests.then(() => handleRequest(request));
+  });
+}
+else
+{
+  // We read the configuration from STDIN rather than as an argument to improve
+  // the output on error. Otherwise the (fairly huge) configuration is printed
+  // along with the actual error message.
+  let inputChunks = [];
+  process.stdin.setEncoding("utf-8");
+  process.stdin.on("data", chunk => { inputChunks.push(chunk); });
+  process.stdin.on("end", () =>
+  {
+    runWebpack(JSON.parse(inputChunks.join("")), (err, output) =>
+    {
+      if (err)
+        throw err;
+      console.log(JSON.stringify(output));
+    });
+  });
+}